@@ -0,0 +1,75 @@
+"""Stand-in for the production DatabaseClient, blocking like the real one.
+
+BENCH_DB_LATENCY_MS sets how long every call sleeps.
+"""
+
+import os
+import random
+import time
+
+DB_LATENCY = float(os.getenv("BENCH_DB_LATENCY_MS", 5)) / 1000  # s
+
+
+def top_rows(count, type=None):
+    types = ["FilmType.FILM", "FilmType.TV_SERIES"]
+    rows = []
+    for i in range(count):
+        kp_id = 1000 + i
+        row_type = types[i % len(types)]
+        if type is not None and row_type != type:
+            continue
+        rows.append(
+            {
+                "kp_id": kp_id,
+                "cover": f"https://stub/posters/{kp_id}.jpg",
+                "title": f"Фильм {kp_id}",
+                "year": 1950 + kp_id % 75,
+                "rating_kp": 7.0,
+                "rating_imdb": 7.0,
+                "url_kp": f"https://www.kinopoisk.ru/film/{kp_id}/",
+                "url_imdb": f"https://www.imdb.com/title/tt{kp_id:07d}/",
+                "type": row_type,
+                "views_count": count - i,
+            }
+        )
+    return rows
+
+
+class DatabaseClient:
+    def _wait(self):
+        time.sleep(random.expovariate(1 / DB_LATENCY) if DB_LATENCY else 0)
+
+    def get_enabled_players(self, name):
+        self._wait()
+        return {"name": name, "is_enabled": True}
+
+    def check_id_is_blocked(self, kp_id):
+        self._wait()
+        return None
+
+    def insert_video_stats(self, *row):
+        self._wait()
+
+    def get_top_video_stats(self, type=None):
+        self._wait()
+        return top_rows(200, type)
+
+    def get_top_video_stats_30_days(self, type=None):
+        self._wait()
+        return top_rows(150, type)
+
+    def get_top_video_stats_7_days(self, type=None):
+        self._wait()
+        return top_rows(100, type)
+
+    def get_top_video_stats_1_days(self, type=None):
+        self._wait()
+        return top_rows(50, type)
+
+    def get_pl_1(self):
+        self._wait()
+        return {"data": "#EXTM3U\n"}
+
+    def get_dons(self):
+        self._wait()
+        return [{"name": f"donor {i}"} for i in range(20)]
@@ -0,0 +1,39 @@
+"""Stand-in for kinopoisk_unofficial that asks bench/stubs.py instead.
+
+Only the calls kinoserver makes are implemented, blocking like the real
+client.
+"""
+
+import os
+import types
+
+import requests
+
+from kinopoisk_unofficial.model.film import Film
+
+STUB_URL = os.getenv("BENCH_STUB_URL", "http://127.0.0.1:9100")
+
+
+class FilmsService:
+    def __init__(self, token):
+        self.session = requests.Session()
+        self.session.headers["X-API-KEY"] = token
+
+    def send_film_request(self, request):
+        response = self.session.get(f"{STUB_URL}/kinopoisk/api/v2.2/films/{request.id}")
+        response.raise_for_status()
+        return types.SimpleNamespace(film=Film.from_dict(response.json()))
+
+    def send_search_by_keyword_request(self, request):
+        response = self.session.get(
+            f"{STUB_URL}/kinopoisk/api/v2.1/films/search-by-keyword",
+            params={"keyword": request.keyword, "page": request.page},
+        )
+        response.raise_for_status()
+        films = [Film.from_dict(film) for film in response.json()["films"]]
+        return types.SimpleNamespace(films=films)
+
+
+class KinopoiskApiClient:
+    def __init__(self, token):
+        self.films = FilmsService(token)
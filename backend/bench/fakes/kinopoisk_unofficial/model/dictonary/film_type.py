@@ -0,0 +1,9 @@
+from enum import Enum
+
+
+class FilmType(Enum):
+    FILM = "FILM"
+    VIDEO = "VIDEO"
+    TV_SERIES = "TV_SERIES"
+    MINI_SERIES = "MINI_SERIES"
+    TV_SHOW = "TV_SHOW"
@@ -0,0 +1,30 @@
+import dataclasses
+
+from kinopoisk_unofficial.model.dictonary.film_type import FilmType
+
+
+@dataclasses.dataclass
+class Film:
+    kinopoisk_id: int
+    imdb_id: str | None
+    name_ru: str | None
+    name_en: str | None
+    name_original: str | None
+    poster_url: str
+    poster_url_preview: str
+    rating_kinopoisk: float | None
+    rating_kinopoisk_vote_count: int
+    rating_imdb: float | None
+    rating_imdb_vote_count: int
+    web_url: str
+    year: int | None
+    slogan: str | None
+    type: FilmType
+    film_id: int | None = None
+
+    @classmethod
+    def from_dict(cls, data):
+        fields = {field.name for field in dataclasses.fields(cls)}
+        data = {key: value for key, value in data.items() if key in fields}
+        data["type"] = FilmType(data["type"])
+        return cls(**data)
@@ -0,0 +1,6 @@
+import dataclasses
+
+
+@dataclasses.dataclass
+class FilmRequest:
+    id: int
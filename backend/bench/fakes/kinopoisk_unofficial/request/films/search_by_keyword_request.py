@@ -0,0 +1,7 @@
+import dataclasses
+
+
+@dataclasses.dataclass
+class SearchByKeywordRequest:
+    keyword: str
+    page: int = 1
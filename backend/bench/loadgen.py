@@ -0,0 +1,190 @@
+"""Closed-loop load generator for a running kinoserver.
+
+Every worker picks a request from the scenario mix (or the next line of a
+replay file), sends it, records the latency and repeats until --duration is
+over. Titles follow a Zipf-like popularity curve so caches see realistic
+hit rates.
+
+Replay files are JSON lines, e.g. extracted from access logs:
+
+    {"method": "POST", "path": "/cache", "form": {"kinopoisk": "301"}}
+    {"method": "GET", "path": "/top/7d", "params": {"type": "movie"}}
+
+    python -m bench.loadgen --url http://127.0.0.1:5788 -c 50 -d 60
+"""
+
+import argparse
+import asyncio
+import collections
+import itertools
+import random
+import time
+
+import aiohttp
+import ujson
+
+SCENARIOS = {
+    "cache": 0.7,
+    "search": 0.1,
+    "top": 0.1,
+    "kp_info": 0.1,
+}
+TITLES = 5000
+SEARCH_TERMS = ["матрица", "интерстеллар", "дюна", "аватар", "начало", "шерлок"]
+TOP_PERIODS = ["all", "30d", "7d", "24h"]
+TOP_TYPES = ["all", "movie", "series"]
+
+
+def pick_title():
+    # rank 1 is the most popular, long tail up to TITLES
+    return 300 + min(int(random.paretovariate(1.1)), TITLES)
+
+
+def make_request(scenario):
+    if scenario == "cache":
+        return {
+            "method": "POST",
+            "path": "/cache",
+            "form": {"kinopoisk": str(pick_title()), "type": "movie"},
+        }
+    if scenario == "search":
+        return {"method": "GET", "path": f"/search/{random.choice(SEARCH_TERMS)}"}
+    if scenario == "top":
+        return {
+            "method": "GET",
+            "path": f"/top/{random.choice(TOP_PERIODS)}",
+            "params": {"type": random.choice(TOP_TYPES)},
+        }
+    return {"method": "GET", "path": f"/kp_info/{pick_title()}"}
+
+
+def scenario_requests(mix):
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    while True:
+        scenario = random.choices(names, weights)[0]
+        yield scenario, make_request(scenario)
+
+
+def replay_requests(path):
+    with open(path) as f:
+        lines = [ujson.loads(line) for line in f if line.strip()]
+    for line in itertools.cycle(lines):
+        yield line["path"].split("/")[1], line
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+async def worker(session, url, requests, deadline, latencies, statuses):
+    while time.monotonic() < deadline:
+        name, request = next(requests)
+        started = time.perf_counter()
+        try:
+            async with session.request(
+                request.get("method", "GET"),
+                url + request["path"],
+                data=request.get("form"),
+                params=request.get("params"),
+            ) as response:
+                await response.read()
+                status = str(response.status)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            status = type(e).__name__
+        latencies[name].append(time.perf_counter() - started)
+        statuses[name][status] += 1
+
+
+async def run(url, concurrency, duration, requests, timeout):
+    latencies = collections.defaultdict(list)
+    statuses = collections.defaultdict(collections.Counter)
+    deadline = time.monotonic() + duration
+    async with aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=concurrency),
+        timeout=aiohttp.ClientTimeout(total=timeout),
+    ) as session:
+        started = time.monotonic()
+        await asyncio.gather(
+            *[
+                worker(session, url, requests, deadline, latencies, statuses)
+                for _ in range(concurrency)
+            ]
+        )
+        elapsed = time.monotonic() - started
+    return report(latencies, statuses, elapsed)
+
+
+def report(latencies, statuses, elapsed):
+    result = {}
+    for name in sorted(latencies) + ["total"]:
+        if name == "total":
+            values = list(itertools.chain.from_iterable(latencies.values()))
+            counts = sum(statuses.values(), collections.Counter())
+        else:
+            values = latencies[name]
+            counts = statuses[name]
+        result[name] = {
+            "requests": len(values),
+            "rps": round(len(values) / elapsed, 1),
+            "p50_ms": round(percentile(values, 0.5) * 1000, 1),
+            "p95_ms": round(percentile(values, 0.95) * 1000, 1),
+            "p99_ms": round(percentile(values, 0.99) * 1000, 1),
+            "statuses": dict(counts),
+        }
+    return result
+
+
+def print_report(result):
+    print(f"{'':10} {'requests':>9} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8}")
+    for name, row in result.items():
+        print(
+            f"{name:10} {row['requests']:>9} {row['rps']:>8} {row['p50_ms']:>8}"
+            f" {row['p95_ms']:>8} {row['p99_ms']:>8}  {row['statuses']}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://127.0.0.1:5788")
+    parser.add_argument("-c", "--concurrency", type=int, default=20)
+    parser.add_argument("-d", "--duration", type=float, default=30)  # s
+    parser.add_argument("--timeout", type=float, default=30)  # s, per request
+    parser.add_argument(
+        "--mix",
+        help="scenario weights, e.g. cache=0.9,top=0.1",
+    )
+    parser.add_argument("--replay", help="JSON lines file with requests to replay")
+    parser.add_argument("--json", help="write the report to this file")
+    args = parser.parse_args()
+
+    if args.replay:
+        requests = replay_requests(args.replay)
+    else:
+        mix = SCENARIOS
+        if args.mix:
+            mix = {
+                name: float(weight)
+                for name, weight in (item.split("=") for item in args.mix.split(","))
+            }
+        requests = scenario_requests(mix)
+    result = asyncio.run(
+        run(
+            args.url.rstrip("/"),
+            args.concurrency,
+            args.duration,
+            requests,
+            args.timeout,
+        )
+    )
+    print_report(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            ujson.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Start the upstream stubs and kinoserver against them, run the load, stop.
+
+REDIS_ADDRESS must point at a scratch Redis, kinoserver keeps its caches
+there and --flush-redis empties it before the run so every run starts cold.
+Arguments after -- go to bench.loadgen:
+
+    REDIS_ADDRESS=redis://127.0.0.1:6390/0 python -m bench.run \
+        --workers 4 --flush-redis -- -c 100 -d 60 --json baseline.json
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+import redis
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKES = os.path.join(BACKEND, "bench", "fakes")
+
+
+def wait_ready(url, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=1)
+            return
+        except urllib.error.HTTPError:
+            return
+        except OSError:
+            time.sleep(0.5)
+    raise RuntimeError(f"{url} did not come up in {timeout}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=5799)
+    parser.add_argument("--stub-port", type=int, default=9100)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--profile", help="JSON file with stub overrides")
+    parser.add_argument("--flush-redis", action="store_true")
+    parser.add_argument("loadgen", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    if not os.getenv("REDIS_ADDRESS"):
+        sys.exit("REDIS_ADDRESS must point at a scratch Redis")
+    if args.flush_redis:
+        redis.from_url(os.environ["REDIS_ADDRESS"]).flushdb()
+
+    stub_url = f"http://127.0.0.1:{args.stub_port}"
+    env = dict(
+        os.environ,
+        PYTHONPATH=os.pathsep.join([FAKES, BACKEND]),
+        UPSTREAM_STUB_URL=stub_url,
+        BENCH_STUB_URL=stub_url,
+    )
+    stub_command = [sys.executable, "-m", "bench.stubs", "--port", str(args.stub_port)]
+    if args.profile:
+        stub_command += ["--profile", args.profile]
+    # kinoserver serves ./yohoho statically
+    workdir = tempfile.mkdtemp(prefix="kinobench-")
+    os.mkdir(os.path.join(workdir, "yohoho"))
+
+    processes = []
+    try:
+        processes.append(subprocess.Popen(stub_command, env=env, cwd=BACKEND))
+        wait_ready(f"{stub_url}/kinopoisk/api/v2.2/films/301")
+        processes.append(
+            subprocess.Popen(
+                [
+                    sys.executable,
+                    "-m",
+                    "sanic",
+                    "kinoserver:app",
+                    "-p",
+                    str(args.port),
+                    "-H",
+                    "127.0.0.1",
+                    f"--workers={args.workers}",
+                ],
+                env=env,
+                cwd=workdir,
+            )
+        )
+        url = f"http://127.0.0.1:{args.port}"
+        wait_ready(f"{url}/metrics")
+        loadgen = [arg for arg in args.loadgen if arg != "--"]
+        subprocess.run(
+            [sys.executable, "-m", "bench.loadgen", "--url", url, *loadgen],
+            env=env,
+            cwd=os.getcwd(),
+            check=True,
+        )
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait(timeout=30)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""Local stand-ins for every upstream kinoserver talks to.
+
+kinoserver sends provider requests to UPSTREAM_STUB_URL/<host>/<path> when
+that variable is set, the fake kinopoisk_unofficial in bench/fakes calls
+/kinopoisk/... Each host answers like the real API with a latency, error and
+miss distribution taken from PROFILE, overridable with --profile profile.json:
+
+    {"apicollaps.cc": {"latency_ms": 800, "error_rate": 0.3}}
+
+    python -m bench.stubs --port 9100
+"""
+
+import argparse
+import asyncio
+import random
+import re
+
+import ujson
+from aiohttp import web
+
+# latency_ms is the median of a lognormal distribution with sigma jitter,
+# timeout_rate answers hang for 30s
+DEFAULT = {
+    "latency_ms": 150,
+    "jitter": 0.5,
+    "error_rate": 0.01,
+    "miss_rate": 0.1,
+    "timeout_rate": 0.0,
+}
+PROFILE = {
+    "apicollaps.cc": {"latency_ms": 200},
+    "api.bhcesh.me": {"latency_ms": 250},
+    "portal.lumex.host": {"latency_ms": 200},
+    "api.cdnmovies.net": {"latency_ms": 300},
+    "api.apbugall.org": {"latency_ms": 350},
+    "4f463c79.obrut.show": {"latency_ms": 400},
+    "kodikapi.com": {"latency_ms": 300, "miss_rate": 0.6},
+    "vibix.org": {"latency_ms": 250},
+    "tv-2-kinoserial.net": {"latency_ms": 400},
+    "kinolordfilm.com": {"latency_ms": 500, "error_rate": 0.05},
+    "militorys.net": {"latency_ms": 300, "miss_rate": 0.7},
+    "localhost:8102": {"latency_ms": 1500, "jitter": 0.8},
+    "localhost:9117": {"latency_ms": 800, "jitter": 0.8},
+    "kinopoisk": {"latency_ms": 400},
+}
+
+
+def kp_id(request):
+    query = request.query_string + request.match_info["tail"]
+    match = re.search(r"(\d+)", query.split("kinopoisk_id=")[-1].split("kp=")[-1])
+    return int(match.group(1)) if match else 301
+
+
+def film(kinopoisk):
+    types = ["FILM", "TV_SERIES", "FILM", "MINI_SERIES", "FILM"]
+    return {
+        "kinopoisk_id": kinopoisk,
+        "imdb_id": f"tt{kinopoisk:07d}",
+        "name_ru": f"Фильм {kinopoisk}",
+        "name_en": f"Film {kinopoisk}",
+        "name_original": f"Film {kinopoisk}",
+        "poster_url": f"https://stub/posters/{kinopoisk}.jpg",
+        "poster_url_preview": f"https://stub/posters/small/{kinopoisk}.jpg",
+        "rating_kinopoisk": round(5 + kinopoisk % 50 / 10, 1),
+        "rating_kinopoisk_vote_count": kinopoisk % 10000,
+        "rating_imdb": round(5 + kinopoisk % 40 / 10, 1),
+        "rating_imdb_vote_count": kinopoisk % 5000,
+        "web_url": f"https://www.kinopoisk.ru/film/{kinopoisk}/",
+        "year": 1950 + kinopoisk % 75,
+        "slogan": None,
+        "type": types[kinopoisk % len(types)],
+    }
+
+
+def answer(host, request):
+    kinopoisk = kp_id(request)
+    tail = request.match_info["tail"]
+    if host in ("apicollaps.cc", "api.bhcesh.me"):
+        return web.json_response(
+            {"results": [{"iframe_url": f"https://stub/collaps/{kinopoisk}"}]}
+        )
+    if host == "portal.lumex.host":
+        return web.json_response(
+            {"data": [{"iframe_src": f"https://stub/lumex/{kinopoisk}"}]}
+        )
+    if host == "api.cdnmovies.net":
+        return web.Response(text='{"data":[{"iframe":"https://stub/cdnmovies"}]}')
+    if host == "api.apbugall.org":
+        return web.json_response(
+            {"data": {"iframe": f"https://stub/alloha/{kinopoisk}"}}
+        )
+    if host == "kodikapi.com":
+        results = [
+            {
+                "title": f"Озвучка {i}",
+                "link": f"//stub/kodik/{kinopoisk}/{i}",
+                "kinopoisk_id": str(kinopoisk),
+            }
+            for i in range(3)
+        ]
+        if "shikimori_id" in request.query:
+            for result in results:
+                result.pop("kinopoisk_id")
+        return web.json_response({"results": results})
+    if host == "vibix.org":
+        return web.json_response({"iframe_url": f"https://stub/vibix/{kinopoisk}"})
+    if host == "tv-2-kinoserial.net":
+        if tail.startswith("embed"):
+            return web.Response(text="<html></html>")
+        raise web.HTTPFound(f"/{host}/embed/{kinopoisk}")
+    if host == "kinolordfilm.com":
+        return web.json_response([{"iframe_url": f"https://stub/hdvb/{kinopoisk}"}])
+    if host == "militorys.net":
+        return web.Response(text='{"playlist_id": 1}')
+    if host == "localhost:8102":
+        return web.json_response(
+            [
+                f'"hdrezka{i}":{{"iframe":"https://stub:4435/rezka/{kinopoisk}/{i}",'
+                f'"translate":"HDREZKA>Озвучка {i}","quality":"1080p"}}'
+                for i in range(2)
+            ]
+        )
+    if host == "localhost:9117":
+        return web.json_response(
+            [{"quality": 2160, "title": "hdr HEVC"}, {"quality": 1080, "title": ""}]
+        )
+    if host == "kinopoisk":
+        if tail.startswith("search"):
+            keyword = request.query.get("keyword", "")
+            return web.json_response(
+                {
+                    "films": [
+                        dict(film(1000 + i), film_id=1000 + i, name_ru=f"{keyword} {i}")
+                        for i in range(10)
+                    ]
+                }
+            )
+        return web.json_response(film(int(tail.rsplit("/", 1)[-1])))
+    return web.Response(text="<html></html>")
+
+
+def make_app(profile):
+    async def handle(request):
+        host = request.match_info["host"]
+        settings = {**DEFAULT, **profile.get(host, {})}
+        latency = random.lognormvariate(0, settings["jitter"])
+        await asyncio.sleep(settings["latency_ms"] * latency / 1000)
+        roll = random.random()
+        if roll < settings["timeout_rate"]:
+            await asyncio.sleep(30)
+        roll -= settings["timeout_rate"]
+        if roll < settings["error_rate"]:
+            raise web.HTTPInternalServerError()
+        roll -= settings["error_rate"]
+        if roll < settings["miss_rate"] and host != "kinopoisk":
+            raise web.HTTPNotFound()
+        return answer(host, request)
+
+    app = web.Application()
+    app.router.add_route("*", "/{host}/{tail:.*}", handle)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--profile", help="JSON file with per-host overrides")
+    args = parser.parse_args()
+    profile = {host: dict(settings) for host, settings in PROFILE.items()}
+    if args.profile:
+        with open(args.profile) as f:
+            for host, settings in ujson.load(f).items():
+                profile.setdefault(host, {}).update(settings)
+    web.run_app(make_app(profile), host="127.0.0.1", port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,32 +1,55 @@
 from sanic import Sanic, response
-from sanic.response import json, text, raw
+from sanic.response import json, text, raw, empty
 from sanic.log import logger
 from sanic.exceptions import ServerError, SanicException
 from sanic_cors import CORS
 from db_client.db_client import DatabaseClient
 from aiohttp_client_cache import CachedSession, RedisBackend, SQLiteBackend
-from aiohttp import ClientSession
+from aiohttp import ClientSession, TCPConnector, UnixConnector
 from enum import Enum
 import ujson
+import orjson
+import gzip
+import hashlib
 import dataclasses
 import requests
 import os
 import re
+import time
+import uuid
 import asyncio
+import typing
+import bisect
+import collections
+import contextlib
+import math
+import random
+import hmac
+import ipaddress
+import sys
+import threading
+import traceback
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import unquote
-from aiocache import cached
-from aiocache.serializers import PickleSerializer
-from urllib.parse import urlparse
+from urllib.parse import urlparse, urlsplit
 
 from kinopoisk_unofficial.kinopoisk_api_client import KinopoiskApiClient
 from kinopoisk_unofficial.request.films.search_by_keyword_request import (
     SearchByKeywordRequest,
 )
 from kinopoisk_unofficial.model.dictonary.film_type import FilmType
+from kinopoisk_unofficial.model.film import Film
 from kinopoisk_unofficial.request.films.film_request import FilmRequest
 import geoip2.database
 from datetime import timedelta
 from dotenv import load_dotenv
+from redis import asyncio as aioredis
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 load_dotenv()
 app = Sanic("reyohoho")
@@ -41,6 +64,8 @@ VIBIX_TOKEN = os.getenv("VIBIX_TOKEN")
 KODIK_TOKEN = os.getenv("KODIK_TOKEN")
 REDIS_ADDRESS = os.getenv("REDIS_ADDRESS")
 GEOIP_DB_PATH = os.getenv("GEOIP_DB_PATH")
+# benchmarks send every upstream request to local stand-ins, see bench/
+UPSTREAM_STUB_URL = os.getenv("UPSTREAM_STUB_URL")
 
 origins = [
     "https://reyohoho.github.io",
@@ -67,497 +92,2410 @@ cors = CORS(
 
 CACHE_TOP_TTL = 86400  # 24h
 CACHE_PL_TTL = 600  # 10m
+CACHE_FILM_TTL = 604800  # 7d
+CACHE_SEARCH_TTL = 86400  # 24h
+CACHE_RESULT_TTL = 900  # 15m, served fresh
+CACHE_RESULT_STALE_TTL = 10800  # 3h, served stale while refreshing
+KODIK_TTL = 21600  # 6h, normalized Kodik result sets
+KODIK_NEGATIVE_TTL = 900  # 15m, ids Kodik does not know, doubles per repeat
+# bump a namespace when what its keys hold changes, a deploy then misses only
+# those keys and the old ones expire on their own. 0 is the unversioned layout
+# the caches started with
+CACHE_NAMESPACES = {
+    "film": 1,
+    "search": 0,
+    "result": 0,
+    "provider": 0,
+    "kodik": 0,
+    "misses": 0,
+}
+# fan-outs per client, tokens per second and burst, shared by the workers
+RATE_LIMIT_IP = (
+    float(os.getenv("RATE_LIMIT_IP_RATE", 1)),
+    int(os.getenv("RATE_LIMIT_IP_BURST", 30)),
+)
+RATE_LIMIT_SUBNET = (
+    float(os.getenv("RATE_LIMIT_SUBNET_RATE", 10)),
+    int(os.getenv("RATE_LIMIT_SUBNET_BURST", 200)),
+)
+# Kinopoisk searches per client, autocomplete does not spend fan-out tokens
+RATE_LIMIT_SEARCH_IP = (
+    float(os.getenv("RATE_LIMIT_SEARCH_IP_RATE", 2)),
+    int(os.getenv("RATE_LIMIT_SEARCH_IP_BURST", 60)),
+)
+RATE_LIMIT_SEARCH_SUBNET = (
+    float(os.getenv("RATE_LIMIT_SEARCH_SUBNET_RATE", 20)),
+    int(os.getenv("RATE_LIMIT_SEARCH_SUBNET_BURST", 400)),
+)
+# Kinopoisk film and Kodik id lookups per client that miss the caches
+RATE_LIMIT_LOOKUP_IP = (
+    float(os.getenv("RATE_LIMIT_LOOKUP_IP_RATE", 2)),
+    int(os.getenv("RATE_LIMIT_LOOKUP_IP_BURST", 60)),
+)
+RATE_LIMIT_LOOKUP_SUBNET = (
+    float(os.getenv("RATE_LIMIT_LOOKUP_SUBNET_RATE", 20)),
+    int(os.getenv("RATE_LIMIT_LOOKUP_SUBNET_BURST", 400)),
+)
+RATE_LIMITS = {
+    "fanout": (RATE_LIMIT_IP, RATE_LIMIT_SUBNET),
+    "search": (RATE_LIMIT_SEARCH_IP, RATE_LIMIT_SEARCH_SUBNET),
+    "lookup": (RATE_LIMIT_LOOKUP_IP, RATE_LIMIT_LOOKUP_SUBNET),
+}
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", 64))
+SHED_LOOP_LAG = 0.5  # s, uncached work is refused above this lag
+SHED_RETRY_AFTER = 5  # s
+HEALTH_INTERVAL = 60  # s between provider probes
+HEALTH_REFRESH_INTERVAL = 10  # s between snapshot reads in each worker
+HEALTH_STALE_AFTER = 300  # s, an older snapshot makes /health fail
+NEGATIVE_RESULT_TTL = 60  # s, a title no provider serves, doubles per repeat
+NEGATIVE_MAX_TTL = 21600  # 6h, cap for results and providers alike
+NEGATIVE_JITTER = 0.2  # +-20%
+NEGATIVE_STREAK_TTL = 604800  # 7d a run of misses is remembered
+RESTART_WORKER_TIMEOUT = 60  # s for a replacement worker to start serving
+FANOUT_LEASE_TTL = 15  # s, longer than the fan-out timeout
+FANOUT_WAIT_INTERVAL = 0.2  # s
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 4))
+BLOCKLIST_TTL = 300  # s
+BLOCKLIST_MAX_SIZE = 100000
+BLOCKLIST_CHANNEL = "blocklist"
+CONTENT_CHANNEL = "content"
+STATS_QUEUE_SIZE = 10000
+STATS_BATCH_SIZE = 500
+STATS_FLUSH_INTERVAL = 1  # s
+TOP_REBUILD_INTERVAL = 3600  # s, DB snapshot of the leaderboards
+TOP_REBUILD_WAIT = 30  # s a rebuild waits for stats inserts under way
+TOP_REBUILD_HOLD = 300  # s new stats inserts wait for the snapshot at most
+STATS_INSERT_TTL = 60  # s, an insert of a dead worker stops holding rebuilds
+TOP_RENDER_TTL = 10  # s, serialized leaderboard kept in the worker
+TOP_SIZE = 100
+PREWARM_INTERVAL = 60  # s between passes over the hot titles
+PREWARM_LEADER_TTL = 300  # s
+PREWARM_TOP_N = int(os.getenv("PREWARM_TOP_N", 200))
+PREWARM_RATE = float(os.getenv("PREWARM_RATE", 2))  # refreshes per second
+PREWARM_AHEAD = 300  # s before a result goes stale
+PREWARM_FILM_AHEAD = 86400  # s before a film entry expires
+# referers the hot titles are mostly watched from
+PREWARM_REFERERS = ("https://reyohoho.github.io/", "")
+METRICS_FLUSH_INTERVAL = 5  # s
+METRICS_STALE_AFTER = 60  # s without a flush drops a worker from /metrics
+LOOP_LAG_INTERVAL = 0.5  # s
+# s a single callback may hold the event loop before it is reported
+BLOCKING_THRESHOLD = float(os.getenv("BLOCKING_THRESHOLD", 0.1))
+BLOCKING_CHECK_INTERVAL = 0.02  # s
+BLOCKING_LOG_SIZE = 100
+BLOCKING_STACK_DEPTH = 30
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+PROFILE_MAX_SECONDS = 60  # s
+PROFILE_INTERVAL = 0.005  # s between stack samples
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BATCH_MAX_IDS = 50
+BATCH_CONCURRENCY = 4
+BREAKER_WINDOW = 60  # s
+BREAKER_MIN_CALLS = 10
+BREAKER_ERROR_RATE = 0.5
+BREAKER_COOLDOWN = 30  # s before a background probe
+HEDGE_PERCENTILE = 0.9
+HEDGE_MIN_DELAY = 0.2  # s
+HEDGE_DEFAULT_DELAY = 1  # s, until enough latencies are recorded
+COMPRESS_MIN_SIZE = 1024  # bytes
+COMPRESS_CACHE_SIZE = 2048
+GEOIP_CACHE_SIZE = 65536
+GEOIP_CACHE_TTL = 3600  # s
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", 200))
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", 20))
+HTTP_DNS_CACHE_TTL = 300  # s
+HTTP_KEEPALIVE_TIMEOUT = 60  # s
+HDREZKA_URL = os.getenv("HDREZKA_URL", "http://localhost:8102")
+# Unix socket of the sidecar, HDREZKA_URL then only names the host
+HDREZKA_SOCKET = os.getenv("HDREZKA_SOCKET")
+# s, results per kp_id. 0 asks the sidecar per client IP and keys the merged
+# /cache payloads by client IP too, for setups where its links are bound to it
+HDREZKA_TTL = int(os.getenv("HDREZKA_TTL", 1800))
+HDREZKA_MAX_IN_FLIGHT = 8
+HDREZKA_TIMEOUT = 9  # s
+HDREZKA_SLOW_CALL = 7  # s, the sidecar scrapes and is slow by design
+SEARCH_LIMIT = 20
+SEARCH_LOCAL_MIN_RESULTS = 5
+SEARCH_SCAN_LIMIT = 2000
+# titles in each worker's index and in each Redis hash that seeds it, the
+# least searched and watched ones are dropped first
+TITLE_INDEX_SIZE = int(os.getenv("TITLE_INDEX_SIZE", 50000))
+TITLE_INDEX_INSORT_MAX = 64  # new keys inserted one by one, more are sorted in
+# hash of titles from Kinopoisk searches, outside the search:<term> keys
+SEARCH_INDEX_KEY = "search_index"
+# hash of the last view of each title, new /top entries take their meta from it
+TOP_TITLES_KEY = "top:titles"
+KINOPOISK_POOL_SIZE = int(os.getenv("KINOPOISK_POOL_SIZE", 8))
 
 kinopoisk_api_client = KinopoiskApiClient(KINOPOISK_TECH_API_TOKEN)
 session_hdr = requests.Session()
 app.static("/", "yohoho", index="index.html")
-geo_reader = geoip2.database.Reader(GEOIP_DB_PATH)
 
 
-async def get_video_from_hdrezka(request, kinopoisk, type, name, year, referer):
-    try:
-        search_text2 = name
-        iframes = []
-        if search_text2 is None:
-            return None
-        if len(search_text2) == 0:
-            return None
-        client_ip = request.headers.get("x-real-ip", request.remote_addr)
-        if client_ip is None or len(client_ip) == 0:
-            if type is None:
-                return None
-            client_ip = "45.136.199.126"  # uptime kuma
-        async with ClientSession() as session:
-            async with session.get(
-                f"http://localhost:8102/get_rezka/{search_text2}/{kinopoisk}/{year}/{client_ip}",
-                timeout=9,
-            ) as response:
-                try:
-                    response.raise_for_status()
-                    response = await response.json()
-                    if response is None:
-                        return None
-                    for it in response:
-                        iframes.append(it.replace("4435", "4446"))
-                    return iframes
-                except Exception as e:
-                    logger.warning(f"Failed  hdrezka {kinopoisk}: {e}")
-                    return None
-    except Exception as e:
-        logger.warning(f"Failed  hdrezka {kinopoisk}: {e}")
+def open_geo_reader():
+    # mmap keeps one copy of the database in the page cache for all workers
+    if not GEOIP_DB_PATH:
         return None
+    try:
+        return geoip2.database.Reader(GEOIP_DB_PATH, mode=geoip2.database.MODE_MMAP_EXT)
+    except ValueError:
+        # maxminddb built without its C extension
+        return geoip2.database.Reader(GEOIP_DB_PATH, mode=geoip2.database.MODE_MMAP)
+
+
+geo_reader = open_geo_reader()
+
+
+def upstream_url(url):
+    if UPSTREAM_STUB_URL is None:
+        return url
+    parts = urlsplit(url)
+    query = f"?{parts.query}" if parts.query else ""
+    return f"{UPSTREAM_STUB_URL}/{parts.netloc}{parts.path}{query}"
+
+
+async def run_kinopoisk(func, *args):
+    # kinopoisk_unofficial is blocking, keep it off the event loop
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(app.ctx.kinopoisk_pool, func, *args)
+
+
+METRICS = {
+    "kinoserver_route_latency_seconds": ("histogram", "Handler latency by route"),
+    "kinoserver_responses_total": ("counter", "Responses by route and status"),
+    "kinoserver_provider_latency_seconds": (
+        "histogram",
+        "Upstream provider latency by outcome: success, empty, timeout, error",
+    ),
+    "kinoserver_provider_requests_total": (
+        "counter",
+        "Provider calls by outcome: success, empty, timeout, error, cached, "
+        "stale, filtered, open",
+    ),
+    "kinoserver_http_cache_total": ("counter", "aiohttp cache hits and misses"),
+    "kinoserver_cache_total": ("counter", "Application cache lookups by result"),
+    "kinoserver_db_latency_seconds": ("histogram", "DatabaseClient call latency"),
+    "kinoserver_event_loop_lag_seconds": ("histogram", "Event loop scheduling lag"),
+    "kinoserver_admission_rejected_total": (
+        "counter",
+        "Uncached requests refused with 429 by reason: ip, subnet, in_flight, "
+        "loop_lag",
+    ),
+    "kinoserver_event_loop_blocks_total": (
+        "counter",
+        "Callbacks that held the event loop past the threshold, by route",
+    ),
+    "kinoserver_event_loop_block_seconds": (
+        "histogram",
+        "How long blocking callbacks held the event loop",
+    ),
+}
+
+
+class Metrics:
+    """Per-worker counters and histograms, merged by /metrics."""
+
+    def __init__(self):
+        self.counters = collections.defaultdict(float)
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [[0] * len(LATENCY_BUCKETS), 0.0, 0]
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                histogram[0][i] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+    def snapshot(self):
+        return {
+            "counters": [
+                [name, labels, value] for (name, labels), value in self.counters.items()
+            ],
+            "histograms": [
+                [name, labels, histogram]
+                for (name, labels), histogram in self.histograms.items()
+            ],
+        }
 
 
-async def get_video_from_collaps(kinopoisk):
-    url = f"https://apicollaps.cc/list?token={COLLAPS_TOKEN}&kinopoisk_id={kinopoisk}"
-    async with CachedSession(cache=app.ctx.backend) as session:
+def format_labels(labels):
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+def render_metrics(snapshots):
+    samples = collections.defaultdict(list)
+    for worker, snapshot in snapshots.items():
+        for name, labels, value in snapshot["counters"]:
+            labels = [*labels, ("worker", worker)]
+            samples[name].append(f"{name}{format_labels(labels)} {value}")
+        for name, labels, (buckets, total, count) in snapshot["histograms"]:
+            labels = [*labels, ("worker", worker)]
+            for bound, bucket in zip(LATENCY_BUCKETS, buckets):
+                bucket_labels = format_labels([*labels, ("le", bound)])
+                samples[name].append(f"{name}_bucket{bucket_labels} {bucket}")
+            inf_labels = format_labels([*labels, ("le", "+Inf")])
+            samples[name].append(f"{name}_bucket{inf_labels} {count}")
+            samples[name].append(f"{name}_sum{format_labels(labels)} {total}")
+            samples[name].append(f"{name}_count{format_labels(labels)} {count}")
+    lines = []
+    for name, (kind, description) in METRICS.items():
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(samples[name])
+    return "\n".join(lines) + "\n"
+
+
+def worker_name():
+    return os.getenv("SANIC_WORKER_NAME", str(os.getpid()))
+
+
+async def flush_metrics():
+    while True:
+        await asyncio.sleep(METRICS_FLUSH_INTERVAL)
         try:
-            async with session.get(url, timeout=5) as response:
-                response.raise_for_status()
-                response = await response.json()
-                first_result = response["results"][0]
-                iframe_iframe = format_result(
-                    "collaps", first_result["iframe_url"], f"COLLAPS", ""
-                )
-                return iframe_iframe
+            snapshot = app.ctx.metrics.snapshot()
+            snapshot["ts"] = time.time()
+            await app.ctx.redis.hset(
+                "metrics:workers", worker_name(), orjson.dumps(snapshot)
+            )
         except Exception as e:
-            logger.warning(f"Error processing collaps API: {e}")
-            url = f"https://api.bhcesh.me/list?token={COLLAPS_TOKEN}&kinopoisk_id={kinopoisk}"
-            try:
-                async with session.get(url, timeout=5) as response:
-                    response.raise_for_status()
-                    response = await response.json()
-                    first_result = response["results"][0]
-                    iframe_iframe = format_result(
-                        "collaps",
-                        first_result["iframe_url"],
-                        f"COLLAPS",
-                        "",
-                    )
-                    return iframe_iframe
-            except Exception as e:
-                logger.warning(f"Error processing bhcesh(collaps) API: {e}")
-                return None
+            logger.warning(f"Failed flush metrics: {e}")
+
+
+async def monitor_loop_lag():
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = time.perf_counter() - started - LOOP_LAG_INTERVAL
+        app.ctx.metrics.observe("kinoserver_event_loop_lag_seconds", max(lag, 0))
+        app.ctx.loop_lag = lag
+
+
+class LoopWatchdog:
+    """Reports callbacks that hold the event loop past BLOCKING_THRESHOLD.
+
+    The loop bumps a heartbeat, a thread grabs the loop thread's stack and the
+    route of the running task as soon as the heartbeat stops moving.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.blocks = collections.deque(maxlen=BLOCKING_LOG_SIZE)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self.watch, name="loop-watchdog", daemon=True
+        )
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    async def beat(self):
+        while True:
+            self.heartbeat = time.monotonic()
+            await asyncio.sleep(BLOCKING_CHECK_INTERVAL)
+
+    def current_route(self):
+        task = asyncio.current_task(self.loop)
+        if task is None:
+            return "callback"
+        return app.ctx.task_routes.get(task) or task.get_name()
+
+    def watch(self):
+        stalled = None
+        while not self.stopped.wait(BLOCKING_CHECK_INTERVAL):
+            heartbeat = self.heartbeat
+            if stalled is not None and heartbeat != stalled[0]:
+                # the beat slept one interval after the callback returned
+                duration = heartbeat - stalled[0] - BLOCKING_CHECK_INTERVAL
+                self.loop.call_soon_threadsafe(self.record, *stalled[1:], duration)
+                stalled = None
+            if stalled is None and time.monotonic() - heartbeat > BLOCKING_THRESHOLD:
+                frame = sys._current_frames().get(self.thread_id)
+                stack = traceback.format_stack(frame, limit=BLOCKING_STACK_DEPTH)
+                stalled = (heartbeat, time.time(), self.current_route(), stack)
+
+    def record(self, ts, route, stack, duration):
+        self.blocks.append(
+            {
+                "ts": ts,
+                "route": route,
+                "duration": round(duration, 3),
+                "stack": "".join(stack),
+            }
+        )
+        app.ctx.metrics.inc("kinoserver_event_loop_blocks_total", route=route)
+        app.ctx.metrics.observe("kinoserver_event_loop_block_seconds", duration)
+        logger.warning(
+            f"Event loop blocked for {duration:.3f}s in {route}:\n{''.join(stack)}"
+        )
+
+
+def sample_stacks(thread_ids, seconds):
+    # folded stacks, one "frame;frame;... count" line each, for flamegraphs
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    samples = collections.Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == threading.get_ident():
+                continue
+            if thread_ids is not None and thread_id not in thread_ids:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                filename = os.path.basename(code.co_filename)
+                stack.append(f"{code.co_name} ({filename}:{frame.f_lineno})")
+                frame = frame.f_back
+            stack.append(names.get(thread_id, str(thread_id)))
+            samples[";".join(reversed(stack))] += 1
+        time.sleep(PROFILE_INTERVAL)
+    return "".join(f"{stack} {count}\n" for stack, count in samples.most_common())
+
+
+def check_debug_token(request):
+    # header only, query strings end up in access logs
+    token = request.headers.get("x-debug-token", "")
+    return PROFILE_TOKEN is not None and hmac.compare_digest(
+        token.encode(), PROFILE_TOKEN.encode()
+    )
+
+
+def cache_key(namespace, *parts):
+    version = CACHE_NAMESPACES[namespace]
+    prefix = (namespace, f"v{version}") if version else (namespace,)
+    return ":".join([*prefix, *map(str, parts)])
 
 
-async def get_video_from_lumex(kinopoisk):
+async def redis_get(key):
     try:
-        url = f"https://portal.lumex.host/api/short?api_token={LUMEX_TOKEN}&kinopoisk_id={kinopoisk}"
-        async with CachedSession(cache=app.ctx.backend) as session:
-            async with session.get(url, timeout=5) as response:
-                response.raise_for_status()
-                response = await response.json(content_type=None)
-                first_result = response["data"][0]
-                iframe_iframe = format_result(
-                    "videocdn", first_result["iframe_src"], f"LUMEX", ""
-                )
-                return iframe_iframe
+        return await app.ctx.redis.get(key)
     except Exception as e:
-        logger.warning(f"Failed lumex: {e}")
+        logger.warning(f"Failed redis get {key}: {e}")
         return None
 
 
-async def get_video_from_cdnmovies(kinopoisk, referer):
+async def redis_set(key, value, ttl):
     try:
-        if "github" in referer:
-            return None
-        url = f"https://api.cdnmovies.net/v1/contents?token={CDNMOVIES_TOKEN}&kinopoisk_id={kinopoisk}"
-        async with CachedSession(cache=app.ctx.backend) as session:
-            async with session.get(url, timeout=5) as response:
-                response.raise_for_status()
-                response = await response.text()
-                if "iframe" in response:
-                    iframe_iframe = format_result(
-                        "cdnmovies",
-                        f"https://ugly-turkey.cdnmovies-stream.online/kinopoisk/{kinopoisk}/iframe?domain=reyohoho.github.io",
-                        "CDNMOVIES",
-                        "",
-                    )
-                    return iframe_iframe
-                return None
+        await app.ctx.redis.set(key, value, ex=ttl)
     except Exception as e:
-        logger.warning(f"Failed cdnmovies: {e}")
+        logger.warning(f"Failed redis set {key}: {e}")
+
+
+RELEASE_LEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+async def acquire_lease(name, ttl):
+    token = uuid.uuid4().hex
+    try:
+        if await app.ctx.redis.set(name, token, nx=True, ex=ttl):
+            return token
         return None
+    except Exception as e:
+        # without redis every worker is on its own
+        logger.warning(f"Failed acquire lease {name}: {e}")
+        return token
+
+
+RENEW_LEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("expire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+async def renew_lease(name, token, ttl):
+    try:
+        return bool(await app.ctx.redis.eval(RENEW_LEASE_SCRIPT, 1, name, token, ttl))
+    except Exception as e:
+        logger.warning(f"Failed renew lease {name}: {e}")
+        return False
+
+
+async def release_lease(name, token):
+    try:
+        await app.ctx.redis.eval(RELEASE_LEASE_SCRIPT, 1, name, token)
+    except Exception as e:
+        logger.warning(f"Failed release lease {name}: {e}")
+
+
+# drops all but the ARGV[1] most recently written fields of the hash KEYS[1],
+# KEYS[2] holds their write times
+TRIM_HASH_SCRIPT = """
+local overflow = redis.call("zrange", KEYS[2], 0, -tonumber(ARGV[1]) - 1)
+for i = 1, #overflow, 1000 do
+    local fields = {unpack(overflow, i, math.min(i + 999, #overflow))}
+    redis.call("hdel", KEYS[1], unpack(fields))
+    redis.call("zrem", KEYS[2], unpack(fields))
+end
+return #overflow
+"""
+
+
+def hset_recent(pipe, key, mapping, size):
+    pipe.hset(key, mapping=mapping)
+    pipe.zadd(f"{key}:written", dict.fromkeys(mapping, time.time()))
+    pipe.eval(TRIM_HASH_SCRIPT, 2, key, f"{key}:written", size)
+
+
+# takes up to ARGV[2] tokens from every bucket, as many as the emptiest has
+TOKEN_BUCKET_SCRIPT = """
+local now = tonumber(ARGV[1])
+local granted = tonumber(ARGV[2])
+local levels = {}
+local wait = 0
+local empty = 0
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2 + 1])
+    local burst = tonumber(ARGV[i * 2 + 2])
+    local bucket = redis.call("hmget", key, "tokens", "ts")
+    local tokens = tonumber(bucket[1]) or burst
+    local elapsed = math.max(0, now - (tonumber(bucket[2]) or now))
+    levels[i] = math.min(burst, tokens + elapsed * rate)
+    granted = math.max(0, math.min(granted, math.floor(levels[i])))
+    if levels[i] < 1 and (1 - levels[i]) / rate > wait then
+        wait = (1 - levels[i]) / rate
+        empty = i
+    end
+end
+if granted == 0 then
+    return {tostring(wait), empty, 0}
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2 + 1])
+    local burst = tonumber(ARGV[i * 2 + 2])
+    redis.call("hset", key, "tokens", levels[i] - granted, "ts", now)
+    redis.call("expire", key, math.ceil(burst / rate) + 1)
+end
+return {"0", 0, granted}
+"""
+
+
+def client_address(request):
+    return request.headers.get("x-real-ip", request.remote_addr)
+
+
+async def take_tokens(client_ip, scope, cost=1):
+    # (seconds until both the IP and its subnet have a token, the empty one,
+    # tokens taken up to cost), 0 seconds once some are taken
+    try:
+        subnet = geo_subnet(client_ip)
+    except ValueError:
+        subnet = client_ip
+    ip_limit, subnet_limit = RATE_LIMITS[scope]
+    try:
+        wait, empty, granted = await app.ctx.redis.eval(
+            TOKEN_BUCKET_SCRIPT,
+            2,
+            f"ratelimit:{scope}:ip:{client_ip}",
+            f"ratelimit:{scope}:subnet:{subnet}",
+            time.time(),
+            cost,
+            *ip_limit,
+            *subnet_limit,
+        )
+        return float(wait), ("ip", "subnet")[empty - 1] if empty else None, granted
+    except Exception as e:
+        # without redis nobody is limited
+        logger.warning(f"Failed rate limit {client_ip}: {e}")
+        return 0, None, cost
+
+
+def reject(reason, retry_after):
+    app.ctx.metrics.inc("kinoserver_admission_rejected_total", reason=reason)
+    return SanicException(
+        "Too many requests",
+        status_code=429,
+        headers={"Retry-After": str(math.ceil(retry_after))},
+    )
 
 
-async def get_video_from_alloha(kinopoisk):
+@contextlib.asynccontextmanager
+async def admission(request, scope="fanout", cost=1):
+    # wraps work that goes upstream, answers from cache never get here. Work
+    # of several upstream calls costs one token each and yields how many of
+    # them may run
+    if app.ctx.loop_lag > SHED_LOOP_LAG:
+        raise reject("loop_lag", SHED_RETRY_AFTER)
+    if app.ctx.admitted >= ADMISSION_MAX_IN_FLIGHT:
+        raise reject("in_flight", SHED_RETRY_AFTER)
+    granted = cost
+    client_ip = client_address(request)
+    if client_ip:
+        wait, empty, granted = await take_tokens(client_ip, scope, cost)
+        if not granted:
+            raise reject(empty, wait)
+    app.ctx.admitted += 1
     try:
-        url = f"https://api.apbugall.org/?token={ALLOHA_TOKEN}&kp={kinopoisk}"
-        async with CachedSession(cache=app.ctx.backend) as session:
-            async with session.get(url, timeout=5) as response:
-                response.raise_for_status()
-                response = await response.json(content_type=None)
-                first_result = response["data"]
-                new_url = re.sub(
-                    r"https://[^/]+",
-                    "https://attractive-as.allarknow.online",
-                    first_result["iframe"],
+        yield granted
+    finally:
+        app.ctx.admitted -= 1
+
+
+async def single_flight(flights, key, factory):
+    # concurrent callers in this worker share one factory() call
+    pending = flights.get(key)
+    if pending is None:
+        pending = asyncio.ensure_future(factory())
+        flights[key] = pending
+        pending.add_done_callback(lambda _: flights.pop(key, None))
+    return await asyncio.shield(pending)
+
+
+async def admitted_flight(request, scope, flights, key, factory):
+    # single_flight() for upstream lookups, only the request that starts the
+    # call is admitted, joining one under way costs nothing
+    if request is None or key in flights:
+        return await single_flight(flights, key, factory)
+    async with admission(request, scope):
+        return await single_flight(flights, key, factory)
+
+
+def normalize_term(term):
+    term = term.lower().replace("ё", "е")
+    return " ".join(re.sub(r"[^\w]+", " ", term).split())
+
+
+class TitleIndex:
+    """Word-prefix index over the titles this worker has seen most often."""
+
+    def __init__(self, size):
+        self.size = size
+        # sorted (title from a word boundary on, film id)
+        self.keys = []
+        self.entries = {}
+        self.hits = collections.Counter()
+
+    def add(self, *entries):
+        new_ids = []
+        for entry in entries:
+            film_id = entry["id"]
+            self.hits[film_id] += 1
+            if film_id not in self.entries:
+                self.entries[film_id] = entry
+                new_ids.append(film_id)
+        if len(self.entries) > self.size:
+            self.evict()
+        new_keys = []
+        for film_id in new_ids:
+            if film_id in self.entries:
+                words = normalize_term(self.entries[film_id]["title"]).split()
+                new_keys.extend(
+                    (" ".join(words[i:]), film_id) for i in range(len(words))
                 )
-                iframe_iframe = format_result(
-                    "alloha",
-                    new_url,
-                    "ALLOHA",
-                    "",
+        if len(new_keys) <= TITLE_INDEX_INSORT_MAX:
+            for key in new_keys:
+                bisect.insort(self.keys, key)
+        else:
+            # seeding, one sort instead of an insort per key
+            self.keys.extend(new_keys)
+            self.keys.sort()
+
+    def evict(self):
+        # down to 90% so the next additions do not evict again right away,
+        # newer titles win ties
+        ranked = sorted(reversed(self.entries), key=lambda film_id: -self.hits[film_id])
+        for film_id in ranked[int(self.size * 0.9) :]:
+            del self.entries[film_id]
+            del self.hits[film_id]
+        self.keys = [key for key in self.keys if key[1] in self.entries]
+
+    def search(self, term, limit):
+        term = normalize_term(term)
+        if not term:
+            return []
+        found = set()
+        start = bisect.bisect_left(self.keys, (term,))
+        for suffix, film_id in self.keys[start : start + SEARCH_SCAN_LIMIT]:
+            if not suffix.startswith(term):
+                break
+            found.add(film_id)
+        ranked = sorted(found, key=lambda film_id: -self.hits[film_id])
+        return [self.entries[film_id] for film_id in ranked[:limit]]
+
+
+def index_film(kp_id, film):
+    if film.year in [None, "None", "null"]:
+        return
+    app.ctx.title_index.add(
+        {
+            "id": kp_id,
+            "title": (film.name_ru or film.name_en or film.name_original)
+            + f" ({film.year})",
+            "poster": film.poster_url_preview,
+        }
+    )
+
+
+async def load_title_index():
+    # seed from titles in video stats and from earlier searches
+    try:
+        entries = []
+        for meta in (await app.ctx.redis.hgetall(TOP_TITLES_KEY)).values():
+            meta = ujson.loads(meta)
+            if meta["title"] and meta["year"] not in [None, "None", "null"]:
+                entries.append(
+                    {
+                        "id": int(meta["kp_id"]),
+                        "title": f"{meta['title']} ({meta['year']})",
+                        "poster": meta["cover"],
+                    }
                 )
-                return iframe_iframe
+        for entry in (await app.ctx.redis.hgetall(SEARCH_INDEX_KEY)).values():
+            entries.append(ujson.loads(entry))
+        app.ctx.title_index.add(*entries)
     except Exception as e:
-        logger.warning(f"Failed alloha: {e}")
+        logger.warning(f"Failed load title index: {e}")
+
+
+# Enum fields of Film, stored by value
+FILM_ENUMS = {
+    name: enum
+    for name, hint in typing.get_type_hints(Film).items()
+    for enum in (hint, *typing.get_args(hint))
+    if isinstance(enum, type) and issubclass(enum, Enum)
+}
+
+
+def dump_film(film):
+    return orjson.dumps(dataclasses.asdict(film))
+
+
+def load_film(cached_film):
+    # an entry written for another version of Film counts as a miss
+    try:
+        fields = orjson.loads(cached_film)
+        for name, enum in FILM_ENUMS.items():
+            if fields.get(name) is not None:
+                fields[name] = enum(fields[name])
+        return Film(**fields)
+    except (TypeError, ValueError) as e:
+        logger.info(f"Dropped cached film: {e}")
         return None
 
 
-async def get_video_from_hdvb(kinopoisk):
+async def get_film(kp_id: int, refresh=False, request=None):
+    key = cache_key("film", kp_id)
+    cached_film = None if refresh else await redis_get(key)
+    film = None if cached_film is None else load_film(cached_film)
+    app.ctx.metrics.inc(
+        "kinoserver_cache_total",
+        cache="film",
+        result="miss" if film is None else "hit",
+    )
+    if film is not None:
+        index_film(kp_id, film)
+        return film
+
+    response_by_id = await admitted_flight(
+        request,
+        "lookup",
+        app.ctx.film_requests,
+        kp_id,
+        lambda: run_kinopoisk(
+            kinopoisk_api_client.films.send_film_request, FilmRequest(kp_id)
+        ),
+    )
+    film = response_by_id.film
+    await redis_set(key, dump_film(film), CACHE_FILM_TTL)
+    index_film(kp_id, film)
+    return film
+
+
+async def search_films(request, term: str):
+    key = cache_key("search", normalize_term(term))
+    cached_search = await redis_get(key)
+    app.ctx.metrics.inc(
+        "kinoserver_cache_total",
+        cache="search",
+        result="miss" if cached_search is None else "hit",
+    )
+    if cached_search is not None:
+        return ujson.loads(cached_search)
+
+    async with admission(request, "search"):
+        response = await run_kinopoisk(
+            kinopoisk_api_client.films.send_search_by_keyword_request,
+            SearchByKeywordRequest(term),
+        )
+    movies = [
+        {
+            "id": film.film_id,
+            "title": (film.name_ru or film.name_en or film.name_original)
+            + f" ({film.year})",
+            "poster": film.poster_url_preview,
+        }
+        for film in response.films
+        if film.year not in [None, "None", "null"]
+    ]
+    await redis_set(key, ujson.dumps(movies, ensure_ascii=False), CACHE_SEARCH_TTL)
+    if movies:
+        app.ctx.title_index.add(*movies)
+        try:
+            pipe = app.ctx.redis.pipeline(transaction=False)
+            hset_recent(
+                pipe,
+                SEARCH_INDEX_KEY,
+                {
+                    movie["id"]: ujson.dumps(movie, ensure_ascii=False)
+                    for movie in movies
+                },
+                TITLE_INDEX_SIZE,
+            )
+            await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Failed store search index: {e}")
+    return movies
+
+
+db_local = threading.local()
+
+
+def db_client():
+    # one DatabaseClient per DB pool thread, reused by every call on it
+    client = getattr(db_local, "client", None)
+    if client is None:
+        client = db_local.client = DatabaseClient()
+    return client
+
+
+def call_db(func, *args):
     try:
-        # see new domain on https://github.com/hdvb-player/hdvb-player.github.io/blob/main/actualize.js
-        url = f"https://kinolordfilm.com/api/videos.json?token={HDVB_TOKEN}&id_kp={kinopoisk}"
-        async with CachedSession(cache=app.ctx.backend) as session:
-            async with session.get(url, timeout=5) as response:
-                response.raise_for_status()
-                response = await response.json(content_type=None)
-                first_result = response[0]
-                iframe_iframe = format_result(
-                    "hdvb",
-                    first_result["iframe_url"],
-                    "HDVB",
-                    "",
-                )
-                return iframe_iframe
+        return func(*args)
+    except Exception:
+        # the next call on this thread starts from a fresh client
+        db_local.client = None
+        raise
+
+
+async def run_db(func, *args):
+    # DatabaseClient is blocking, keep it off the event loop
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    try:
+        return await loop.run_in_executor(app.ctx.db_pool, call_db, func, *args)
+    finally:
+        app.ctx.metrics.observe(
+            "kinoserver_db_latency_seconds",
+            time.perf_counter() - started,
+            call=func.__name__,
+        )
+
+
+def check_blocked(kp_id):
+    return db_client().check_id_is_blocked(kp_id) is not None
+
+
+async def is_blocked(kp_id: int):
+    now = time.monotonic()
+    entry = app.ctx.blocklist.get(kp_id)
+    if entry is not None and entry[1] > now:
+        return entry[0]
+
+    blocked = await single_flight(
+        app.ctx.blocklist_checks, kp_id, lambda: run_db(check_blocked, kp_id)
+    )
+    if len(app.ctx.blocklist) >= BLOCKLIST_MAX_SIZE:
+        app.ctx.blocklist = {
+            key: value for key, value in app.ctx.blocklist.items() if value[1] > now
+        }
+    app.ctx.blocklist[kp_id] = (blocked, now + BLOCKLIST_TTL)
+    return blocked
+
+
+def invalidate_blocklist(data):
+    # a kp_id drops it from every worker, "*" drops everything
+    if data == "*":
+        app.ctx.blocklist.clear()
+    elif data.isnumeric():
+        app.ctx.blocklist.pop(int(data), None)
+
+
+def load_pl_list_1():
+    return db_client().get_pl_1()["data"].encode()
+
+
+def load_dons():
+    return "\n".join([item["name"] for item in db_client().get_dons()]).encode()
+
+
+# rarely changing DB content, kept encoded in every worker
+CONTENT_LOADERS = {
+    "pl_list_1": load_pl_list_1,
+    "dons": load_dons,
+}
+
+
+def invalidate_content(data):
+    # a CONTENT_LOADERS name drops it from every worker, "*" drops everything
+    if data == "*":
+        app.ctx.content.clear()
+    else:
+        app.ctx.content.pop(data, None)
+
+
+async def load_content(name):
+    body = await run_db(CONTENT_LOADERS[name])
+    etag = make_etag(body)
+    app.ctx.content[name] = (body, etag, time.monotonic() + CACHE_PL_TTL)
+    return body, etag
+
+
+async def get_content(name):
+    entry = app.ctx.content.get(name)
+    if entry is not None and entry[2] > time.monotonic():
+        app.ctx.metrics.inc("kinoserver_cache_total", cache="content", result="hit")
+        return entry[:2]
+    app.ctx.metrics.inc("kinoserver_cache_total", cache="content", result="miss")
+    try:
+        return await single_flight(
+            app.ctx.content_loads, name, lambda: load_content(name)
+        )
     except Exception as e:
-        logger.warning(f"Failed hdvb: {e}")
-        return None
+        if entry is None:
+            raise
+        # the expired copy beats an error while the DB is down
+        logger.warning(f"Failed load {name}, serving expired copy: {e}")
+        return entry[:2]
 
 
-async def get_video_from_vibix(kinopoisk):
-    try:
-        url = f"https://vibix.org/api/v1/publisher/videos/kp/{kinopoisk}"
-        async with CachedSession(cache=app.ctx.backend) as session:
-            async with session.get(
-                url,
-                timeout=5,
-                headers={"Authorization": f"Bearer {VIBIX_TOKEN}"},
-            ) as response:
-                response.raise_for_status()
-                response = await response.json(content_type=None)
-                first_result = response
-                iframe_iframe = format_result(
-                    "vibix", first_result["iframe_url"], "VIBIX", ""
-                )
-                return iframe_iframe
+INVALIDATION_HANDLERS = {
+    BLOCKLIST_CHANNEL: invalidate_blocklist,
+    CONTENT_CHANNEL: invalidate_content,
+}
+
+
+async def listen_invalidations():
+    # messages published to these channels reach every worker, entries
+    # missed while disconnected still expire by TTL
+    while True:
+        try:
+            pubsub = app.ctx.redis.pubsub()
+            await pubsub.subscribe(*INVALIDATION_HANDLERS)
+            async for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+                handler = INVALIDATION_HANDLERS[message["channel"].decode()]
+                handler(message["data"].decode())
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Invalidation listener failed: {e}")
+            await asyncio.sleep(5)
+
+
+def insert_stats_batch(rows):
+    # DatabaseClient has no bulk insert, so a batch saves the per-request
+    # client and connection but still sends one INSERT per view
+    db = db_client()
+    for row in rows:
+        try:
+            db.insert_video_stats(*row)
+        except Exception as e:
+            logger.error(f"Error insert to video stats DB: ${e}")
+
+
+# registers a stats insert in KEYS[2] unless a /top snapshot is being taken
+BEGIN_STATS_INSERT_SCRIPT = """
+if redis.call("exists", KEYS[1]) == 1 then
+    return 0
+end
+redis.call("zadd", KEYS[2], ARGV[2], ARGV[1])
+return 1
+"""
+
+
+async def begin_stats_insert():
+    # waits out a /top snapshot, the token is registered until
+    # end_stats_insert() so the next snapshot waits for this insert
+    token = uuid.uuid4().hex
+    while True:
+        try:
+            if await app.ctx.redis.eval(
+                BEGIN_STATS_INSERT_SCRIPT,
+                2,
+                "top:rebuilding",
+                "top:inserting",
+                token,
+                time.time() + STATS_INSERT_TTL,
+            ):
+                return token
+        except Exception as e:
+            # without redis there are no deltas to keep consistent
+            logger.warning(f"Failed register stats insert: {e}")
+            return None
+        await asyncio.sleep(STATS_FLUSH_INTERVAL)
+
+
+async def end_stats_insert(token):
+    if token is None:
+        return
+    try:
+        await app.ctx.redis.zrem("top:inserting", token)
     except Exception as e:
-        logger.warning(f"Failed vibix: {e}")
+        logger.warning(f"Failed unregister stats insert: {e}")
+
+
+async def flush_stats():
+    queue = app.ctx.stats_queue
+    while True:
+        rows = [await queue.get()]
+        deadline = time.monotonic() + STATS_FLUSH_INTERVAL
+        try:
+            while len(rows) < STATS_BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    rows.append(await asyncio.wait_for(queue.get(), timeout=timeout))
+                except asyncio.TimeoutError:
+                    break
+            token = await begin_stats_insert()
+        except asyncio.CancelledError:
+            # shutting down, keep the batch for drain_stats()
+            for row in rows:
+                queue.put_nowait(row)
+            raise
+        try:
+            # no snapshot starts before end_stats_insert(), so these rows
+            # count into the generation they are inserted in
+            generation = int(await redis_get("top:generation") or 0)
+            try:
+                await run_db(insert_stats_batch, rows)
+            except Exception as e:
+                logger.error(f"Error flush {len(rows)} video stats: {e}")
+            await count_top_views(rows, generation)
+        finally:
+            await end_stats_insert(token)
+
+
+@dataclasses.dataclass
+class RequestContext:
+    kinopoisk: str
+    video_type: str | None
+    client_ip: str | None
+    referer: str
+    country: str | None = None
+    name: str | None = None
+    year: int | None = None
+    # probes skip the HTTP and provider caches
+    live: bool = False
+
+    @classmethod
+    def from_request(cls, request, kinopoisk, video_type):
+        # headers and GeoIP are resolved once per request, every provider and
+        # the stats row share the result
+        client = getattr(request.ctx, "client", None)
+        if client is None:
+            client_ip = client_address(request)
+            client = request.ctx.client = (
+                client_ip,
+                str(request.headers.get("referer")),
+                lookup_country(client_ip),
+            )
+        client_ip, referer, country = client
+        return cls(
+            kinopoisk=kinopoisk,
+            video_type=video_type,
+            client_ip=client_ip,
+            referer=referer,
+            country=country,
+        )
+
+    @property
+    def facets(self):
+        # request properties that change the merged /cache payload
+        facets = (
+            f"g{int('github' in self.referer)}"
+            f"t{int(self.country in turbo_block_countries)}"
+        )
+        if not HDREZKA_TTL:
+            # hdrezka links are only valid for the IP they were fetched for
+            facets += f"i{self.client_ip or ''}"
+        return facets
+
+    def for_film(self, kinopoisk, film):
+        return dataclasses.replace(
+            self,
+            kinopoisk=kinopoisk,
+            name=film.name_ru or film.name_en or film.name_original,
+            year=film.year,
+        )
+
+
+def geo_subnet(client_ip):
+    # countries are assigned to whole blocks, /24 for IPv4 and /48 for IPv6
+    if ":" in client_ip:
+        return ipaddress.ip_address(client_ip).exploded[:14]
+    return client_ip.rpartition(".")[0]
+
+
+def lookup_country(client_ip):
+    if geo_reader is None or not client_ip:
+        return None
+    try:
+        subnet = geo_subnet(client_ip)
+    except ValueError as e:
+        logger.warning(f"Failed check geoip: {e}")
         return None
+    cached_country = app.ctx.geo_cache.get(subnet)
+    if cached_country is not None and cached_country[1] > time.monotonic():
+        app.ctx.geo_cache.move_to_end(subnet)
+        return cached_country[0]
+    country = None
+    try:
+        country = geo_reader.country(client_ip).country.iso_code
+    except Exception as e:
+        logger.warning(f"Failed check geoip: {e}")
+    app.ctx.geo_cache[subnet] = (country, time.monotonic() + GEOIP_CACHE_TTL)
+    app.ctx.geo_cache.move_to_end(subnet)
+    if len(app.ctx.geo_cache) > GEOIP_CACHE_SIZE:
+        app.ctx.geo_cache.popitem(last=False)
+    return country
+
+
+turbo_block_countries = {"AU", "CA", "FR", "DE", "NL", "ES", "TR", "GB", "US", "JP"}
+
+
+class ProviderError(Exception):
+    pass
+
+
+@dataclasses.dataclass(frozen=True)
+class Provider:
+    name: str
+    # url builders taking the RequestContext, mirrors follow the primary
+    urls: tuple
+    # async (ctx, response) -> iframe, list of iframes or None
+    parse: object
+    ttl: int = 10800  # s, parsed hits
+    negative_ttl: int = 900  # s, parsed misses and raw HTTP responses
+    max_in_flight: int = 32
+    timeout: float = 5  # s, per HTTP request
+    deadline: float = 10  # s, whole provider call incl. mirrors and queueing
+    # s, median latency that opens the circuit breaker
+    slow_call: float = 4
+    headers: dict | None = None
+    # ctx -> bool, skipped calls are not cached
+    applies: object = None
+    # localhost services go through the uncached session
+    local: bool = False
+    # ctx -> part of the cache key, the kinopoisk id by default
+    key: object = None
+    # s past ttl the entry is still served while a background call refreshes it
+    stale_ttl: int = 0
+    # async ctx -> result, replaces requesting urls for providers with their
+    # own client
+    fetch: object = None
+
+
+async def parse_collaps(ctx, response):
+    response = await response.json()
+    first_result = response["results"][0]
+    return format_result("collaps", first_result["iframe_url"], f"COLLAPS", "")
+
+
+async def parse_lumex(ctx, response):
+    response = await response.json(content_type=None)
+    first_result = response["data"][0]
+    return format_result("videocdn", first_result["iframe_src"], f"LUMEX", "")
+
+
+async def parse_cdnmovies(ctx, response):
+    response = await response.text()
+    if "iframe" in response:
+        return format_result(
+            "cdnmovies",
+            f"https://ugly-turkey.cdnmovies-stream.online/kinopoisk/{ctx.kinopoisk}/iframe?domain=reyohoho.github.io",
+            "CDNMOVIES",
+            "",
+        )
+    return None
+
+
+async def parse_alloha(ctx, response):
+    response = await response.json(content_type=None)
+    first_result = response["data"]
+    new_url = re.sub(
+        r"https://[^/]+",
+        "https://attractive-as.allarknow.online",
+        first_result["iframe"],
+    )
+    return format_result("alloha", new_url, "ALLOHA", "")
+
+
+async def parse_hdvb(ctx, response):
+    response = await response.json(content_type=None)
+    first_result = response[0]
+    return format_result("hdvb", first_result["iframe_url"], "HDVB", "")
+
+
+async def parse_vibix(ctx, response):
+    response = await response.json(content_type=None)
+    return format_result("vibix", response["iframe_url"], "VIBIX", "")
+
+
+async def parse_militorys(ctx, response):
+    text_test = await response.text()
+    if "playlist_id" in text_test:
+        return format_result(
+            "militorys",
+            f"https://militorys.net/van/{ctx.kinopoisk}",
+            "MILITORYS",
+            "",
+        )
+    return None
 
 
-async def get_video_from_militorys(kinopoisk):
-    try:
-        url = f"https://militorys.net/api/{kinopoisk}"
-        async with CachedSession(cache=app.ctx.backend) as session:
-            async with session.get(url, timeout=5) as response:
-                response.raise_for_status()
-                text_test = await response.text()
-                if "playlist_id" in text_test:
-                    iframe_iframe = format_result(
-                        "militorys",
-                        f"https://militorys.net/van/{kinopoisk}",
-                        "MILITORYS",
-                        "",
-                    )
-                    return iframe_iframe
+async def parse_videoseed(ctx, response):
+    if "embed" in str(response.url):
+        return format_result("videoseed", str(response.url), "VIDEOSEED", "")
+    return None
+
+
+async def parse_turbo(ctx, response):
+    return format_result(
+        "turbo",
+        "https://4f463c79.obrut.show/embed/IDN/kinopoisk/" + str(ctx.kinopoisk),
+        "TURBO",
+        "",
+    )
+
+
+def normalize_kodik(results):
+    entry = {
+        "kinopoisk_id": None,
+        "shikimori_id": None,
+        "info": None,
+        "translations": [],
+    }
+    seen_titles = set()
+    for result in results:
+        entry["kinopoisk_id"] = entry["kinopoisk_id"] or result.get("kinopoisk_id")
+        entry["shikimori_id"] = entry["shikimori_id"] or result.get("shikimori_id")
+        if entry["info"] is None:
+            entry["info"] = {
+                "name_ru": result.get("title"),
+                "name_en": result.get("title_orig"),
+                "slogan": result.get("other_title"),
+                "year": result.get("year"),
+            }
+        title = result["title"]
+        if title in seen_titles:
+            continue
+        seen_titles.add(title)
+        entry["translations"].append((title, result["link"]))
+    return entry
+
+
+async def load_kodik(field, value):
+    url = f"https://kodikapi.com/search?token={KODIK_TOKEN}&{field}={value}"
+    async with app.ctx.http.get(upstream_url(url), timeout=5) as response:
+        response.raise_for_status()
+        response = await response.json(content_type=None)
+    entry = normalize_kodik(response.get("results", []))
+    data = orjson.dumps(entry)
+    # misses are counted per looked up id, a shikimori id has its own field
+    if entry["translations"]:
+        ttl = KODIK_TTL
+        await clear_misses(value, f"kodik:{field}")
+    else:
+        ttl = negative_ttl(
+            KODIK_NEGATIVE_TTL, await count_miss(value, f"kodik:{field}")
+        )
+    await redis_set(cache_key("kodik", field, value), data, ttl)
+    # the same result set answers a lookup by the other id
+    for other in ("kinopoisk_id", "shikimori_id"):
+        if other != field and entry[other]:
+            try:
+                await app.ctx.redis.set(
+                    cache_key("kodik", other, entry[other]), data, ex=ttl, nx=True
+                )
+            except Exception as e:
+                logger.warning(f"Failed redis set kodik {other}: {e}")
+    return entry
+
+
+async def get_kodik(field, value, request=None):
+    # field is kinopoisk_id or shikimori_id, one Kodik search per id and TTL
+    cached_entry = await redis_get(cache_key("kodik", field, value))
+    if cached_entry is not None:
+        app.ctx.metrics.inc("kinoserver_cache_total", cache="kodik", result="hit")
+        return orjson.loads(cached_entry)
+    app.ctx.metrics.inc("kinoserver_cache_total", cache="kodik", result="miss")
+    return await admitted_flight(
+        request,
+        "lookup",
+        app.ctx.kodik_requests,
+        (field, value),
+        lambda: load_kodik(field, value),
+    )
+
+
+async def fetch_kodik(ctx):
+    try:
+        if ctx.live:
+            entry = await load_kodik("kinopoisk_id", ctx.kinopoisk)
+        else:
+            entry = await get_kodik("kinopoisk_id", ctx.kinopoisk)
     except Exception as e:
-        logger.warning(f"Failed militorys: {e}")
-        return None
+        logger.warning(f"Failed kodik: {e}")
+        raise ProviderError(f"kodik: {e}") from e
+    return [
+        format_result(f"kodik{50 - i}", f"https:{link}", f"KODIK>{title}", "")
+        for i, (title, link) in enumerate(entry["translations"])
+    ]
+
 
+async def parse_torrents(ctx, response):
+    results = await response.json()
+    max_quality = 480
+    hdr = hevc = dolby = False
+    # one pass over the string fields instead of str(results) per flag
+    for result in results:
+        if result["quality"] > max_quality:
+            max_quality = result["quality"]
+        for value in result.values():
+            if not isinstance(value, str):
+                continue
+            hdr = hdr or "hdr" in value
+            value = value.lower()
+            hevc = hevc or "hevc" in value
+            dolby = dolby or "dolby" in value
+    quality_text = ""
+    if max_quality != 480:
+        quality_text = f"{max_quality}p"
+    quality_text += " HDR/SDR" if hdr else " SDR"
+    if hevc:
+        quality_text += " HEVC"
+    if dolby:
+        quality_text += " Dolby Vision"
+    return format_result(
+        "torrents",
+        "https://reyohoho.space:4437/template/reyohoho_vip.html",
+        f"ReYohoho VIP>{quality_text}",
+        "",
+    )
 
-async def get_video_from_videoseed(kinopoisk):
+
+def parse_hdrezka(fragments):
+    # the sidecar answers '"name":{...}' members of the /cache object
+    fragments = [it.replace("4435", "4446").strip().rstrip(",") for it in fragments]
+    members = orjson.loads("{" + ",".join(fragments) + "}")
+    return [
+        format_result(
+            src_name, member["iframe"], member["translate"], member["quality"]
+        )
+        for src_name, member in members.items()
+    ]
+
+
+async def request_hdrezka(ctx):
+    client_ip = ctx.client_ip
+    if client_ip is None or len(client_ip) == 0:
+        client_ip = "45.136.199.126"  # uptime kuma
+    url = f"{HDREZKA_URL}/get_rezka/{ctx.name}/{ctx.kinopoisk}/{ctx.year}/{client_ip}"
     try:
-        url = f"https://tv-2-kinoserial.net/api.php?kp_id={kinopoisk}"
-        async with CachedSession(cache=app.ctx.backend) as session:
-            async with session.get(url, timeout=5, allow_redirects=True) as response:
-                response.raise_for_status()
-                if "embed" in str(response.url):
-                    iframe_iframe = format_result(
-                        "videoseed", str(response.url), "VIDEOSEED", ""
-                    )
-                    return iframe_iframe
+        async with app.ctx.hdrezka.get(
+            upstream_url(url), timeout=HDREZKA_TIMEOUT
+        ) as response:
+            if response.status == 404:
+                return None
+            response.raise_for_status()
+            fragments = await response.json()
     except Exception as e:
-        logger.warning(f"Failed videoseed: {e}")
+        logger.warning(f"Failed hdrezka {ctx.kinopoisk}: {e}")
+        raise ProviderError(f"hdrezka: {e}") from e
+    if not fragments:
+        return None
+    try:
+        return parse_hdrezka(fragments)
+    except (KeyError, TypeError, ValueError) as e:
+        logger.info(f"No iframe from hdrezka: {e}")
         return None
 
 
-turbo_block_countries = {"AU", "CA", "FR", "DE", "NL", "ES", "TR", "GB", "US", "JP"}
+async def fetch_hdrezka(ctx):
+    # one sidecar call per title in this worker, whoever asked first supplies
+    # the client IP
+    key = ctx.kinopoisk if HDREZKA_TTL else (ctx.kinopoisk, ctx.client_ip)
+    return await single_flight(app.ctx.hdrezka_calls, key, lambda: request_hdrezka(ctx))
 
 
-async def get_video_from_turbo(request, kinopoisk):
+PROVIDERS = (
+    Provider(
+        "collaps",
+        (
+            lambda ctx: f"https://apicollaps.cc/list?token={COLLAPS_TOKEN}&kinopoisk_id={ctx.kinopoisk}",
+            lambda ctx: f"https://api.bhcesh.me/list?token={COLLAPS_TOKEN}&kinopoisk_id={ctx.kinopoisk}",
+        ),
+        parse_collaps,
+    ),
+    Provider(
+        "lumex",
+        (
+            lambda ctx: f"https://portal.lumex.host/api/short?api_token={LUMEX_TOKEN}&kinopoisk_id={ctx.kinopoisk}",
+        ),
+        parse_lumex,
+    ),
+    Provider(
+        "cdnmovies",
+        (
+            lambda ctx: f"https://api.cdnmovies.net/v1/contents?token={CDNMOVIES_TOKEN}&kinopoisk_id={ctx.kinopoisk}",
+        ),
+        parse_cdnmovies,
+        applies=lambda ctx: "github" not in ctx.referer,
+    ),
+    Provider(
+        "alloha",
+        (
+            lambda ctx: f"https://api.apbugall.org/?token={ALLOHA_TOKEN}&kp={ctx.kinopoisk}",
+        ),
+        parse_alloha,
+    ),
+    Provider(
+        "turbo",
+        (
+            lambda ctx: f"https://4f463c79.obrut.show/embed/IDN/kinopoisk/{ctx.kinopoisk}",
+        ),
+        parse_turbo,
+        headers={
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/81.0.4044.138 Safari/537.36"
+        },
+        applies=lambda ctx: ctx.country not in turbo_block_countries,
+    ),
+    Provider(
+        "kodik",
+        (),
+        None,
+        # cached by the Kodik index
+        ttl=0,
+        fetch=fetch_kodik,
+    ),
+    Provider(
+        "vibix",
+        (lambda ctx: f"https://vibix.org/api/v1/publisher/videos/kp/{ctx.kinopoisk}",),
+        parse_vibix,
+        headers={"Authorization": f"Bearer {VIBIX_TOKEN}"},
+    ),
+    Provider(
+        "videoseed",
+        (lambda ctx: f"https://tv-2-kinoserial.net/api.php?kp_id={ctx.kinopoisk}",),
+        parse_videoseed,
+    ),
+    Provider(
+        # see new domain on https://github.com/hdvb-player/hdvb-player.github.io/blob/main/actualize.js
+        "hdvb",
+        (
+            lambda ctx: f"https://kinolordfilm.com/api/videos.json?token={HDVB_TOKEN}&id_kp={ctx.kinopoisk}",
+        ),
+        parse_hdvb,
+    ),
+    Provider(
+        "hdrezka",
+        (),
+        None,
+        ttl=HDREZKA_TTL,
+        max_in_flight=HDREZKA_MAX_IN_FLIGHT,
+        timeout=HDREZKA_TIMEOUT,
+        slow_call=HDREZKA_SLOW_CALL,
+        applies=lambda ctx: bool(ctx.name) and bool(ctx.client_ip or ctx.video_type),
+        local=True,
+        fetch=fetch_hdrezka,
+    ),
+    Provider(
+        "militorys",
+        (lambda ctx: f"https://militorys.net/api/{ctx.kinopoisk}",),
+        parse_militorys,
+    ),
+    Provider(
+        "torrents",
+        (
+            lambda ctx: f"http://localhost:9117/api/v1.0/torrents?search={ctx.name}&apikey=null&exact=true",
+        ),
+        parse_torrents,
+        # Jackett searches are slow, the label changes rarely and is shared by
+        # every release of a title
+        ttl=21600,
+        negative_ttl=3600,
+        stale_ttl=604800,
+        applies=lambda ctx: bool(ctx.name),
+        local=True,
+        key=lambda ctx: normalize_term(ctx.name),
+    ),
+)
+PROVIDERS_BY_NAME = {provider.name: provider for provider in PROVIDERS}
+
+# title used to probe providers, same one uptime monitoring checks
+CANARY_CONTEXT = RequestContext(
+    kinopoisk="301",
+    video_type="check",
+    client_ip=None,
+    referer="",
+    name="Матрица",
+    year=1999,
+    live=True,
+)
+
+
+class CircuitBreaker:
+    """Per-worker rolling error rate and latency of one provider."""
+
+    def __init__(self, name, slow_call):
+        self.name = name
+        self.slow_call = slow_call
+        self.calls = collections.deque()
+        self.open_until = 0.0
+        self.probing = False
+
+    @property
+    def is_open(self):
+        return self.open_until > 0
+
+    def record(self, ok, latency):
+        now = time.monotonic()
+        self.calls.append((now, ok, latency))
+        while self.calls and self.calls[0][0] < now - BREAKER_WINDOW:
+            self.calls.popleft()
+        if self.is_open or len(self.calls) < BREAKER_MIN_CALLS:
+            return
+        errors = sum(1 for _, call_ok, _ in self.calls if not call_ok)
+        median = self.percentile(0.5)
+        if errors / len(self.calls) >= BREAKER_ERROR_RATE or (
+            median is not None and median >= self.slow_call
+        ):
+            self.trip()
+
+    def trip(self):
+        logger.warning(f"Circuit open for {self.name}, PID: {os.getpid()}")
+        self.open_until = time.monotonic() + BREAKER_COOLDOWN
+        self.calls.clear()
+
+    def reset(self):
+        logger.warning(f"Circuit closed for {self.name}, PID: {os.getpid()}")
+        self.open_until = 0.0
+
+    def allow(self):
+        if not self.is_open:
+            return True
+        if time.monotonic() >= self.open_until and not self.probing:
+            self.probing = True
+            app.add_task(probe_provider(PROVIDERS_BY_NAME[self.name]))
+        return False
+
+    def percentile(self, q):
+        latencies = sorted(latency for _, ok, latency in self.calls if ok)
+        if not latencies:
+            return None
+        return latencies[min(int(len(latencies) * q), len(latencies) - 1)]
+
+    def hedge_delay(self):
+        if len(self.calls) < BREAKER_MIN_CALLS:
+            return HEDGE_DEFAULT_DELAY
+        delay = self.percentile(HEDGE_PERCENTILE)
+        if delay is None:
+            return HEDGE_DEFAULT_DELAY
+        return max(delay, HEDGE_MIN_DELAY)
+
+
+async def request_url(provider, ctx, url):
+    if provider.local:
+        session = app.ctx.http_local
+        extra = {}
+    else:
+        session = app.ctx.http
+        extra = {"expire_after": 0 if ctx.live else provider.negative_ttl}
     try:
-        url = f"https://4f463c79.obrut.show/embed/IDN/kinopoisk/{kinopoisk}"
-        client_ip = request.headers.get("x-real-ip", request.remote_addr)
-        try:
-            geo_response = geo_reader.country(client_ip)
-            if geo_response.country.iso_code in turbo_block_countries:
-                logger.warning(
-                    f"Turbo block by iso code: {geo_response.country.iso_code}"
+        async with session.get(
+            upstream_url(url(ctx)),
+            timeout=provider.timeout,
+            headers=provider.headers,
+            **extra,
+        ) as response:
+            if not provider.local:
+                app.ctx.metrics.inc(
+                    "kinoserver_http_cache_total",
+                    provider=provider.name,
+                    result="hit" if getattr(response, "from_cache", False) else "miss",
                 )
+            if response.status == 404:
+                return None
+            response.raise_for_status()
+            try:
+                return await provider.parse(ctx, response)
+            except (KeyError, IndexError, TypeError, ValueError) as e:
+                # answered, but without a usable iframe
+                logger.info(f"No iframe from {provider.name}: {e}")
                 return None
-        except Exception as e:
-            logger.warning(f"Failed check geoip: {e}")
-
-        async with CachedSession(cache=app.ctx.backend) as session:
-            async with session.get(
-                url,
-                timeout=5,
-                headers={
-                    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/81.0.4044.138 Safari/537.36"
-                },
-            ) as response:
-                response.raise_for_status()
-                iframe_iframe = format_result(
-                    "turbo",
-                    "https://4f463c79.obrut.show/embed/IDN/kinopoisk/" + str(kinopoisk),
-                    "TURBO",
-                    "",
-                )
-                return iframe_iframe
     except Exception as e:
-        logger.warning(f"Failed turbo: {e}")
-        return None
+        logger.warning(f"Failed {provider.name}: {e}")
+        raise ProviderError(f"{provider.name}: {e}") from e
+
 
+async def request_provider(provider, ctx):
+    if provider.fetch is not None:
+        return await provider.fetch(ctx)
+    if len(provider.urls) == 1:
+        return await request_url(provider, ctx, provider.urls[0])
 
-async def get_video_from_kodik(kinopoisk):
+    # hedged: a mirror starts when the previous url fails or is slower than
+    # the usual latency of this provider, the first answer wins
+    delay = app.ctx.breakers[provider.name].hedge_delay()
+    pending = set()
     try:
-        url = (
-            f"https://kodikapi.com/search?token={KODIK_TOKEN}&kinopoisk_id={kinopoisk}"
+        for url in provider.urls:
+            pending.add(asyncio.ensure_future(request_url(provider, ctx, url)))
+            done, pending = await asyncio.wait(
+                pending, timeout=delay, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+    raise ProviderError(f"{provider.name}: all mirrors failed")
+
+
+async def probe_provider(provider):
+    breaker = app.ctx.breakers[provider.name]
+    try:
+        await asyncio.wait_for(
+            request_provider(provider, CANARY_CONTEXT), timeout=provider.deadline
         )
-        async with CachedSession(cache=app.ctx.backend) as session:
-            async with session.get(url, timeout=5) as response:
-                response.raise_for_status()
-                response = await response.json(content_type=None)
-                k_iframes = []
-                for result in response["results"]:
-                    if result["title"] in str(k_iframes):
-                        continue
-                    iframe_iframe = format_result(
-                        f"kodik{50 - len(k_iframes)}",
-                        f"https:{result['link']}",
-                        f"KODIK>{result['title']}",
-                        "",
-                    )
-                    k_iframes.append(iframe_iframe)
-                return k_iframes
+        breaker.reset()
     except Exception as e:
-        logger.warning(f"Failed kodik: {e}")
-        return None
+        logger.warning(f"Probe {provider.name} failed: {e}")
+        breaker.trip()
+    finally:
+        breaker.probing = False
 
 
-async def get_quality_for_torrents(name):
-    url = (
-        f"http://localhost:9117/api/v1.0/torrents?search={name}&apikey=null&exact=true"
+def count_provider(provider, outcome):
+    app.ctx.metrics.inc(
+        "kinoserver_provider_requests_total", provider=provider.name, outcome=outcome
     )
-    logger.info(url)
-    async with ClientSession() as session:
+
+
+def negative_ttl(base, misses):
+    # grows with every consecutive miss, jittered so misses cached in one
+    # burst do not expire together
+    ttl = base * 2 ** (misses - 1)
+    ttl *= random.uniform(1 - NEGATIVE_JITTER, 1 + NEGATIVE_JITTER)
+    return max(1, round(min(ttl, NEGATIVE_MAX_TTL)))
+
+
+async def count_miss(kinopoisk, field):
+    # one hash per title, "result:<facets>" for the merged payload, a
+    # provider name for each provider and "kodik:<id field>" for Kodik lookups
+    key = cache_key("misses", kinopoisk)
+    try:
+        pipe = app.ctx.redis.pipeline(transaction=False)
+        pipe.hincrby(key, field, 1)
+        pipe.expire(key, NEGATIVE_STREAK_TTL)
+        misses, _ = await pipe.execute()
+        return misses
+    except Exception as e:
+        logger.warning(f"Failed count miss {key} {field}: {e}")
+        return 1
+
+
+async def clear_misses(kinopoisk, field):
+    try:
+        await app.ctx.redis.hdel(cache_key("misses", kinopoisk), field)
+    except Exception as e:
+        logger.warning(f"Failed clear misses {kinopoisk} {field}: {e}")
+
+
+def provider_key(provider, ctx):
+    subject = ctx.kinopoisk if provider.key is None else provider.key(ctx)
+    return cache_key("provider", provider.name, subject)
+
+
+async def store_provider_result(provider, ctx, key, result):
+    if result:
+        ttl = provider.ttl
+        await clear_misses(ctx.kinopoisk, provider.name)
+    else:
+        misses = await count_miss(ctx.kinopoisk, provider.name)
+        ttl = negative_ttl(provider.negative_ttl, misses)
+    if not provider.stale_ttl:
+        await redis_set(key, dump_iframes(result), ttl)
+        return
+    fresh_until = time.time() + ttl
+    await redis_set(
+        key,
+        f"{fresh_until:.0f}\n".encode() + dump_iframes(result),
+        ttl + provider.stale_ttl,
+    )
+
+
+async def run_provider(provider, ctx, failed=None):
+    # failed collects providers that errored instead of answering
+    if provider.applies is not None and not provider.applies(ctx):
+        count_provider(provider, "filtered")
+        return []
+    if not provider.ttl:
+        return await call_provider(provider, ctx, failed=failed)
+    key = provider_key(provider, ctx)
+    cached_result = await redis_get(key)
+    if cached_result is None:
+        return await call_provider(provider, ctx, key, failed)
+
+    outcome = "cached"
+    if provider.stale_ttl:
+        fresh_until, cached_result = cached_result.split(b"\n", 1)
+        if float(fresh_until) < time.time():
+            outcome = "stale"
+            if key not in app.ctx.refreshing:
+                app.ctx.refreshing.add(key)
+                app.add_task(refresh_provider_in_background(provider, ctx, key))
+    count_provider(provider, outcome)
+    return load_iframes(cached_result)
+
+
+async def call_provider(provider, ctx, key=None, failed=None):
+    breaker = app.ctx.breakers[provider.name]
+    if not breaker.allow():
+        count_provider(provider, "open")
+        if failed is not None:
+            failed.append(provider.name)
+        return []
+
+    async def limited():
+        async with app.ctx.provider_limits[provider.name]:
+            return await request_provider(provider, ctx)
+
+    def finish(outcome):
+        # failed calls are timed too, they are the slow tail of /cache
+        elapsed = time.perf_counter() - started
+        breaker.record(outcome in ("success", "empty"), elapsed)
+        count_provider(provider, outcome)
+        app.ctx.metrics.observe(
+            "kinoserver_provider_latency_seconds",
+            elapsed,
+            provider=provider.name,
+            outcome=outcome,
+        )
+
+    started = time.perf_counter()
+    try:
+        result = await asyncio.wait_for(limited(), timeout=provider.deadline)
+    except asyncio.TimeoutError:
+        logger.error(f"Task {provider.name} exceeded timeout, PID: {os.getpid()}")
+        finish("timeout")
+        if failed is not None:
+            failed.append(provider.name)
+        return []
+    except ProviderError:
+        finish("error")
+        if failed is not None:
+            failed.append(provider.name)
+        return []
+
+    if result is None:
+        result = []
+    elif isinstance(result, Iframe):
+        result = [result]
+    finish("success" if result else "empty")
+    if key is not None:
+        await store_provider_result(provider, ctx, key, result)
+    return result
+
+
+async def refresh_provider_in_background(provider, ctx, key):
+    # failed calls keep the stale entry, the next request retries
+    lease = f"lease:{key}"
+    try:
+        token = await acquire_lease(lease, FANOUT_LEASE_TTL)
+        if token is not None:
+            try:
+                await call_provider(provider, ctx, key)
+            finally:
+                await release_lease(lease, token)
+    except Exception as e:
+        logger.warning(f"Failed background refresh {key}: {e}")
+    finally:
+        app.ctx.refreshing.discard(key)
+
+
+async def cache_kodik(kinopoisk: str, request=None) -> tuple[str | None, bytes | None]:
+    shiki_id = re.sub(r"[^0-9]", "", kinopoisk)
+    entry = await get_kodik("shikimori_id", shiki_id, request)
+    if entry["kinopoisk_id"]:
+        return entry["kinopoisk_id"], None
+    iframes = [
+        format_result(f"kodik{i}", f"https:{link}", f"KODIK>{title}", "")
+        for i, (title, link) in enumerate(entry["translations"], 1)
+    ]
+    return None, encode_iframes(iframes)
+
+
+async def hot_titles():
+    hot = {}
+    generation = int(await app.ctx.redis.get("top:generation") or 0)
+    for kp_id in await app.ctx.redis.zrevrange(
+        f"top:delta:{generation}", 0, PREWARM_TOP_N - 1
+    ):
+        hot[kp_id.decode()] = None
+    snapshot = await redis_get("top:snapshot")
+    if snapshot is not None:
+        boards = ujson.loads(snapshot)["boards"]
+        for period in ("24h", "7d"):
+            for row in boards.get(f"{period}:None") or []:
+                hot[str(row["kp_id"])] = None
+    return list(hot)[:PREWARM_TOP_N]
+
+
+async def prewarm_title(kinopoisk):
+    refreshed = False
+    kp_id = int(kinopoisk)
+    film_ttl = await app.ctx.redis.ttl(cache_key("film", kp_id))
+    film = await get_film(kp_id, refresh=0 <= film_ttl < PREWARM_FILM_AHEAD)
+    for referer in PREWARM_REFERERS:
+        ctx = RequestContext(
+            kinopoisk=kinopoisk,
+            video_type="prewarm",
+            client_ip=None,
+            referer=referer,
+        ).for_film(kinopoisk, film)
+        key = result_key(ctx)
+        cached_result = await redis_get(key)
+        if cached_result is not None:
+            _, _, fresh_until = unpack_result(cached_result)
+            if fresh_until - time.time() > PREWARM_AHEAD:
+                continue
+        await refresh_result(ctx, key)
+        refreshed = True
+    return refreshed
+
+
+async def prewarm_hot_titles(token):
+    # at most PREWARM_RATE refreshes per second, spread evenly
+    for kinopoisk in await hot_titles():
+        if not await renew_lease("lease:prewarm", token, PREWARM_LEADER_TTL):
+            return
+        started = time.monotonic()
         try:
-            async with session.get(url, timeout=5) as response:
-                response.raise_for_status()
-                results = await response.json()
-                max_quality = 480
-                hdr = " SDR"
-                dolby = ""
-                hevc = ""
-                for result in results:
-                    if result["quality"] > max_quality:
-                        max_quality = result["quality"]
-                if "hdr" in str(results):
-                    hdr = " HDR/SDR"
-                if "hevc" in str(results).lower():
-                    hevc = " HEVC"
-                if "dolby" in str(results).lower():
-                    dolby = " Dolby Vision"
-                quality_text = ""
-                if max_quality != 480:
-                    quality_text = f"{max_quality}p"
-                iframe_iframe = format_result(
-                    "torrents",
-                    "https://reyohoho.space:4437/template/reyohoho_vip.html",
-                    f"ReYohoho VIP>{quality_text}{hdr}{hevc}{dolby}",
-                    "",
-                )
-                return iframe_iframe
+            if await is_blocked(int(kinopoisk)):
+                continue
+            if not await prewarm_title(kinopoisk):
+                continue
         except Exception as e:
-            logger.warning(f"Error processing torrents API: {e}")
-            return None
+            logger.warning(f"Failed prewarm {kinopoisk}: {e}")
+        await asyncio.sleep(max(0, 1 / PREWARM_RATE - (time.monotonic() - started)))
 
 
-async def cache_kodik(kinopoisk: str) -> tuple[str | None, str | None]:
-    shiki_id = re.sub(r"[^0-9]", "", kinopoisk)
-    url = f"https://kodikapi.com/search?token={KODIK_TOKEN}&shikimori_id={shiki_id}"
-    async with CachedSession(cache=app.ctx.backend) as session:
-        async with session.get(url, timeout=5) as response:
-            response.raise_for_status()
-            response = await response.json(content_type=None)
-            results = response.get("results", [])
+async def prewarm_periodically():
+    # one leader across the workers refreshes hot titles before they expire
+    token = None
+    while True:
+        try:
+            if token is None:
+                token = await acquire_lease("lease:prewarm", PREWARM_LEADER_TTL)
+            elif not await renew_lease("lease:prewarm", token, PREWARM_LEADER_TTL):
+                token = None
+            if token is not None:
+                await prewarm_hot_titles(token)
+        except Exception as e:
+            logger.warning(f"Failed prewarm: {e}")
+        await asyncio.sleep(PREWARM_INTERVAL)
 
-            k_iframes = []
-            iframes = []
-            seen_titles = set()
 
-            for result in results:
-                if "kinopoisk_id" in result:
-                    return result["kinopoisk_id"], None
-                title = result["title"]
-                if title in seen_titles:
-                    continue
+async def probe_health(provider):
+    started = time.perf_counter()
+    error = None
+    try:
+        result = await asyncio.wait_for(
+            request_provider(provider, CANARY_CONTEXT), timeout=provider.deadline
+        )
+        status = "ok" if result else "empty"
+    except asyncio.TimeoutError:
+        status = "timeout"
+    except Exception as e:
+        status = "error"
+        error = str(e)
+    return {
+        "status": status,
+        "latency": round(time.perf_counter() - started, 3),
+        "error": error,
+    }
 
-                seen_titles.add(title)
-                iframe_iframe = format_result(
-                    f"kodik{len(k_iframes) + 1}",
-                    f"https:{result['link']}",
-                    f"KODIK>{title}",
-                    "",
+
+async def check_health():
+    results = await asyncio.gather(*[probe_health(provider) for provider in PROVIDERS])
+    providers = {provider.name: result for provider, result in zip(PROVIDERS, results)}
+    healthy = any(result["status"] == "ok" for result in results)
+    snapshot = {
+        "status": "ok" if healthy else "down",
+        "checked_at": time.time(),
+        "providers": providers,
+    }
+    await redis_set("health:snapshot", orjson.dumps(snapshot), HEALTH_STALE_AFTER)
+    logger.info(f"Health checked: {snapshot['status']}, PID: {os.getpid()}")
+
+
+async def check_health_periodically():
+    # one worker probes every provider with the canary title per interval,
+    # all of them keep the last snapshot in memory for /health
+    while True:
+        try:
+            if await acquire_lease("lease:health", HEALTH_INTERVAL):
+                await check_health()
+            snapshot = await redis_get("health:snapshot")
+            if snapshot is not None:
+                parsed = orjson.loads(snapshot)
+                app.ctx.health = (
+                    snapshot,
+                    parsed["checked_at"],
+                    parsed["status"] == "ok",
                 )
-                k_iframes.append(iframe_iframe)
-                iframes.append(iframe_iframe)
+        except Exception as e:
+            logger.warning(f"Failed health check: {e}")
+        await asyncio.sleep(HEALTH_REFRESH_INTERVAL)
 
-            result = "{" + ",".join(iframes) + "}"
-    return None, result
 
+@app.get("/health")
+async def health(request):
+    if app.ctx.health is None:
+        return json({"status": "starting"}, status=503)
+    snapshot, checked_at, healthy = app.ctx.health
+    fresh = time.time() - checked_at < HEALTH_STALE_AFTER
+    status = 200 if healthy and fresh else 503
+    return raw(snapshot, status=status, content_type="application/json; charset=utf-8")
 
-@app.get("/check_cache")
-async def check_cache(request):
-    r = requests.post(
-        "http://localhost:5788/cache",
-        {"kinopoisk": "301", "code": "31", "type": "check"},
-    )
-    return raw(r.content, status=r.status_code)
 
+# uptime monitoring still polls the old name
+app.add_route(health, "/check_cache", name="check_cache")
 
-@app.post("/cache")
-async def cache_request(request):
-    kinopoisk = request.form.get("kinopoisk")
-    video_type = request.form.get("type", None)
+
+async def prepare_cache_request(request):
+    params = request.form if request.method == "POST" else request.args
+    kinopoisk = params.get("kinopoisk")
     if kinopoisk is None:
-        return json({})
+        return None, None, json({})
     if kinopoisk.startswith("shiki"):
         try:
-            kinopoisk, text_kodik = await cache_kodik(kinopoisk.replace("shiki", ""))
+            kinopoisk, text_kodik = await cache_kodik(
+                kinopoisk.replace("shiki", ""), request
+            )
             if text_kodik:
-                return text(
-                    text_kodik,
-                    headers={"Content-Type": "application/json; charset=utf-8"},
-                )
+                return None, None, payload_response(request, text_kodik)
+        except SanicException:
+            raise
         except:
-            return json({})
+            return None, None, json({})
     try:
         kp_id = int(kinopoisk)
         if kp_id == 0:
-            return json({})
-        if DatabaseClient().check_id_is_blocked(kp_id) is not None:
-            return text("Item blocked", status=403)
+            return None, None, json({})
+        if await is_blocked(kp_id):
+            return None, None, text("Item blocked", status=403)
     except ValueError as e:
         logger.error(f"Kinopoisk ID to int error: {e}")
-        return text("Not int", status=500)
-
-    request_by_id = FilmRequest(int(kinopoisk))
-    response_by_id = kinopoisk_api_client.films.send_film_request(request_by_id)
-    film_by_id = response_by_id.film
-    name = film_by_id.name_ru or film_by_id.name_en or film_by_id.name_original
-
-    tasks = [
-        get_video_from_collaps(kinopoisk),
-        get_video_from_lumex(kinopoisk),
-        get_video_from_cdnmovies(kinopoisk, str(request.headers.get("referer"))),
-        get_video_from_alloha(kinopoisk),
-        get_video_from_turbo(request, kinopoisk),
-        get_video_from_kodik(kinopoisk),
-        get_video_from_vibix(kinopoisk),
-        get_video_from_videoseed(kinopoisk),
-        get_video_from_hdvb(kinopoisk),
-        get_video_from_hdrezka(
-            request,
-            kinopoisk,
-            video_type,
-            name,
-            film_by_id.year,
-            str(request.headers.get("referer")),
-        ),
-        get_video_from_militorys(kinopoisk),
-        get_quality_for_torrents(name),
-    ]
+        return None, None, text("Not int", status=500)
 
-    wrapped_tasks = [asyncio.wait_for(task, timeout=10) for task in tasks]
+    film_by_id = await get_film(kp_id, request=request)
+    ctx = RequestContext.from_request(request, kinopoisk, params.get("type", None))
+    return ctx.for_film(kinopoisk, film_by_id), film_by_id, None
 
-    try:
-        iframe_results = await asyncio.gather(*wrapped_tasks, return_exceptions=True)
-        for i, iframe_result in enumerate(iframe_results):
-            # logger.error(f"Task {i} str, PID: {os.getpid()} {iframe_result}, kp_id: {kinopoisk}")
-            if iframe_result is None:
-                # logger.error(f"Task {i} result is None, kp_id: {kinopoisk}")
-                continue
-            if isinstance(iframe_result, asyncio.TimeoutError):
-                logger.error(f"Task {i} exceeded timeout, PID: {os.getpid()}")
-    except asyncio.TimeoutError as e:
-        logger.error(f"One or more tasks exceeded timeout: {e}, PID: {os.getpid()}")
-
-    iframes = []
-    for result in iframe_results:
-        if isinstance(result, asyncio.TimeoutError):
-            continue
-        if result is None:
-            continue
-        if result:
-            if isinstance(result, list):
-                iframes.extend(result)
-            else:
-                iframes.append(result)
 
-    if len(iframes) > 0:
-        try:
-            client_ip = request.headers.get("x-real-ip", request.remote_addr)
-            logger.info(f"Pre add watch: kp_id: {kinopoisk}, IP:{client_ip}")
-            DatabaseClient().insert_video_stats(
-                kinopoisk,
+def record_watch(ctx, film_by_id):
+    # written behind by flush_stats()
+    try:
+        logger.info(f"Pre add watch: kp_id: {ctx.kinopoisk}, IP:{ctx.client_ip}")
+        app.ctx.stats_queue.put_nowait(
+            (
+                ctx.kinopoisk,
                 film_by_id.poster_url,
-                name,
+                ctx.name,
                 film_by_id.year,
                 film_by_id.rating_kinopoisk,
                 film_by_id.rating_imdb,
                 film_by_id.web_url,
                 f"https://www.imdb.com/title/{film_by_id.imdb_id}/",
                 film_by_id.type,
-                client_ip,
+                ctx.client_ip,
             )
-        except Exception as e:
-            logger.error(f"Error insert to video stats DB: ${e}")
+        )
+    except asyncio.QueueFull:
+        logger.error(f"Video stats queue is full, dropped kp_id: {ctx.kinopoisk}")
+
+
+@app.route("/cache", methods=["GET", "POST"])
+async def cache_request(request):
+    ctx, film_by_id, early_response = await prepare_cache_request(request)
+    if early_response is not None:
+        return early_response
+
+    body, etag = await get_cached_result(request, ctx)
+
+    if body != b"{}":
+        record_watch(ctx, film_by_id)
+
+    return payload_response(request, body, etag)
+
+
+@app.post("/cache/stream")
+async def cache_stream(request):
+    # NDJSON: one {"event":"iframe"} line per iframe as soon as its provider
+    # answers, then a {"event":"done"} summary line
+    ctx, film_by_id, early_response = await prepare_cache_request(request)
+    if early_response is not None:
+        return early_response
+
+    key = result_key(ctx)
+    cached_result = await lookup_result(ctx, key)
+    if cached_result is not None:
+        response = await request.respond(
+            content_type="application/x-ndjson; charset=utf-8"
+        )
+        iframes = orjson.loads(cached_result[0])
+        for src_name, iframe in iframes.items():
+            event = {"event": "iframe", "data": {src_name: iframe}}
+            await response.send(orjson.dumps(event) + b"\n")
+    else:
+        async with admission(request):
+            response = await request.respond(
+                content_type="application/x-ndjson; charset=utf-8"
+            )
+            iframes = []
+            async for iframe in stream_result(ctx, key):
+                event = {
+                    "event": "iframe",
+                    "data": {iframe.src_name: iframe.to_dict()},
+                }
+                await response.send(orjson.dumps(event) + b"\n")
+                iframes.append(iframe)
+
+    summary = {
+        "event": "done",
+        "count": len(iframes),
+        "cached": cached_result is not None,
+    }
+    await response.send(orjson.dumps(summary) + b"\n")
+    await response.eof()
+
+    if iframes:
+        record_watch(ctx, film_by_id)
+
+
+@app.post("/cache/batch")
+async def cache_batch(request):
+    # {"ids": [kp_id or "shiki<id>", ...]} ->
+    # {id: {"available": bool, "iframes": {...}}}, ids that were refused or
+    # failed get "available": null and "error": "refused" or "failed"
+    try:
+        ids = [str(item) for item in request.json["ids"]]
+    except Exception:
+        return text("No ids provided", status=400)
+    ids = list(dict.fromkeys(ids))[:BATCH_MAX_IDS]
+    base_ctx = RequestContext.from_request(request, None, None)
+    limit = asyncio.Semaphore(BATCH_CONCURRENCY)
+    answers = {}
+    errors = {}
+
+    async def resolve_shiki(item):
+        async with limit:
+            kp_id, payload = await cache_kodik(item.replace("shiki", ""), request)
+        if payload is not None:
+            answers[item] = orjson.loads(payload)
+        return kp_id
+
+    kp_ids = {}
+    shiki_ids = [item for item in ids if item.startswith("shiki")]
+    resolved = await asyncio.gather(
+        *[resolve_shiki(item) for item in shiki_ids], return_exceptions=True
+    )
+    for item, kp_id in zip(shiki_ids, resolved):
+        if isinstance(kp_id, SanicException) and kp_id.status_code == 429:
+            errors[item] = "refused"
+        elif isinstance(kp_id, Exception):
+            logger.warning(f"Failed batch item {item}: {kp_id}")
+            errors[item] = "failed"
+        elif kp_id is not None:
+            kp_ids[item] = str(kp_id)
+    for item in ids:
+        if item.isnumeric() and int(item) != 0:
+            kp_ids[item] = item
+
+    # cached titles in one round trip
+    contexts = {
+        item: dataclasses.replace(base_ctx, kinopoisk=kp) for item, kp in kp_ids.items()
+    }
+    keys = [result_key(ctx) for ctx in contexts.values()]
+    try:
+        cached_results = await app.ctx.redis.mget(keys) if keys else []
+    except Exception as e:
+        logger.warning(f"Failed batch mget: {e}")
+        cached_results = [None] * len(keys)
+
+    async def lookup(item, ctx, key, cached_result):
+        # True when the title needs a fan-out
+        if await is_blocked(int(ctx.kinopoisk)):
+            answers[item] = None
+            return False
+        cached_result = use_cached_result(ctx, key, cached_result)
+        if cached_result is None:
+            return True
+        answers[item] = orjson.loads(cached_result[0])
+        return False
+
+    async def resolve(item, ctx, key):
+        async with limit:
+            film = await get_film(int(ctx.kinopoisk))
+            cached_result = await refresh_result(ctx.for_film(ctx.kinopoisk, film), key)
+        answers[item] = orjson.loads(cached_result[0])
+
+    lookups = await asyncio.gather(
+        *[
+            lookup(item, ctx, key, cached_result)
+            for (item, ctx), key, cached_result in zip(
+                contexts.items(), keys, cached_results
+            )
+        ],
+        return_exceptions=True,
+    )
+    uncached = []
+    for (item, ctx), key, outcome in zip(contexts.items(), keys, lookups):
+        if isinstance(outcome, Exception):
+            logger.warning(f"Failed batch item {item}: {outcome}")
+            errors[item] = "failed"
+        elif outcome:
+            uncached.append((item, ctx, key))
+
+    if uncached:
+        # one fan-out token per uncached title, titles past the available
+        # tokens are refused
+        try:
+            async with admission(request, cost=len(uncached)) as granted:
+                for item, _, _ in uncached[granted:]:
+                    errors[item] = "refused"
+                admitted = uncached[:granted]
+                outcomes = await asyncio.gather(
+                    *[resolve(item, ctx, key) for item, ctx, key in admitted],
+                    return_exceptions=True,
+                )
+        except SanicException:
+            for item, _, _ in uncached:
+                errors[item] = "refused"
+        else:
+            for (item, _, _), outcome in zip(admitted, outcomes):
+                if isinstance(outcome, Exception):
+                    logger.warning(f"Failed batch item {item}: {outcome}")
+                    errors[item] = "failed"
+
+    body = orjson.dumps(
+        {
+            item: (
+                {"available": None, "iframes": {}, "error": errors[item]}
+                if item in errors
+                else {
+                    "available": bool(answers.get(item)),
+                    "iframes": answers.get(item) or {},
+                }
+            )
+            for item in ids
+        }
+    )
+    return payload_response(request, body)
+
+
+async def fetch_iframes(ctx, failed=None):
+    results = await asyncio.gather(
+        *[run_provider(provider, ctx, failed) for provider in PROVIDERS]
+    )
+    return [iframe for result in results for iframe in result]
+
+
+async def iter_iframes(ctx, failed=None):
+    # yields iframes in the order providers answer
+    tasks = [run_provider(provider, ctx, failed) for provider in PROVIDERS]
+    for next_result in asyncio.as_completed(tasks):
+        for iframe in await next_result:
+            yield iframe
+
+
+def pack_result(body, etag, fresh_until):
+    return f"{fresh_until:.0f} {etag}\n".encode() + body
+
+
+def unpack_result(entry):
+    header, body = entry.split(b"\n", 1)
+    fresh_until, etag = header.decode().split(" ", 1)
+    return body, etag, float(fresh_until)
 
-    result = "{" + ",".join(iframes) + "}"
-    result = result.replace("},}", "}}")
-    return text(result, headers={"Content-Type": "application/json; charset=utf-8"})
+
+async def store_result(ctx, key, iframes, failed):
+    body = encode_iframes(iframes)
+    etag = make_etag(body)
+    misses_field = f"result:{ctx.facets}"
+    if iframes:
+        fresh_until = time.time() + CACHE_RESULT_TTL
+        await redis_set(
+            key,
+            pack_result(body, etag, fresh_until),
+            CACHE_RESULT_TTL + CACHE_RESULT_STALE_TTL,
+        )
+        await clear_misses(ctx.kinopoisk, misses_field)
+    elif not failed:
+        # every provider answered and none has the title, kept as long again
+        # as stale so refreshes happen in the background
+        ttl = negative_ttl(
+            NEGATIVE_RESULT_TTL, await count_miss(ctx.kinopoisk, misses_field)
+        )
+        await redis_set(key, pack_result(body, etag, time.time() + ttl), ttl * 2)
+    # empty results after failures are not cached, but waiting workers still
+    # need them
+    await redis_set(f"flight:{key}", pack_result(body, etag, 0), FANOUT_LEASE_TTL)
+    return body, etag
+
+
+async def build_result(ctx, key):
+    failed = []
+    iframes = await fetch_iframes(ctx, failed)
+    return await store_result(ctx, key, iframes, failed)
+
+
+async def build_result_leased(ctx, key):
+    lease = f"lease:{key}"
+    token = await acquire_lease(lease, FANOUT_LEASE_TTL)
+    if token is not None:
+        try:
+            return await build_result(ctx, key)
+        finally:
+            await release_lease(lease, token)
+
+    # another worker runs the fan-out, wait for its result
+    deadline = time.monotonic() + FANOUT_LEASE_TTL
+    while time.monotonic() < deadline:
+        await asyncio.sleep(FANOUT_WAIT_INTERVAL)
+        shared_result = await redis_get(f"flight:{key}")
+        if shared_result is None:
+            if await redis_get(lease) is not None:
+                continue
+            # the holder may have stored its result and released the lease
+            # between the two reads
+            shared_result = await redis_get(f"flight:{key}")
+            if shared_result is None:
+                break
+        body, etag, _ = unpack_result(shared_result)
+        return body, etag
+    logger.warning(f"No shared result for {key}, PID: {os.getpid()}")
+    return await build_result(ctx, key)
+
+
+async def refresh_result(ctx, key):
+    return await single_flight(
+        app.ctx.inflight, key, lambda: build_result_leased(ctx, key)
+    )
+
+
+async def stream_fanout(ctx, key, lease, token, queue):
+    # runs to the end even if the streaming client goes away, requests
+    # joining it wait for the stored result
+    try:
+        iframes = []
+        failed = []
+        async for iframe in iter_iframes(ctx, failed):
+            iframes.append(iframe)
+            queue.put_nowait(iframe)
+        return await store_result(ctx, key, iframes, failed)
+    finally:
+        queue.put_nowait(None)
+        await release_lease(lease, token)
+
+
+async def stream_result(ctx, key):
+    # yields iframes as providers answer when this request runs the fan-out,
+    # all at once when it joins one already under way
+    lease = f"lease:{key}"
+    token = None
+    if key not in app.ctx.inflight:
+        token = await acquire_lease(lease, FANOUT_LEASE_TTL)
+    if token is None:
+        body, _ = await refresh_result(ctx, key)
+        for src_name, iframe in orjson.loads(body).items():
+            yield Iframe(src_name, **iframe)
+        return
+
+    queue = asyncio.Queue()
+    fanout = asyncio.ensure_future(stream_fanout(ctx, key, lease, token, queue))
+    app.ctx.inflight[key] = fanout
+    fanout.add_done_callback(lambda _: app.ctx.inflight.pop(key, None))
+    while True:
+        iframe = await queue.get()
+        if iframe is None:
+            break
+        yield iframe
+    await asyncio.shield(fanout)
+
+
+async def refresh_result_in_background(ctx, key):
+    try:
+        if ctx.name is None:
+            ctx = ctx.for_film(ctx.kinopoisk, await get_film(int(ctx.kinopoisk)))
+        await refresh_result(ctx, key)
+    except Exception as e:
+        logger.warning(f"Failed background refresh {key}: {e}")
+    finally:
+        app.ctx.refreshing.discard(key)
+
+
+def result_key(ctx):
+    return cache_key("result", ctx.kinopoisk, ctx.facets)
+
+
+async def lookup_result(ctx, key):
+    return use_cached_result(ctx, key, await redis_get(key))
+
+
+def use_cached_result(ctx, key, cached_result):
+    if cached_result is None:
+        app.ctx.metrics.inc("kinoserver_cache_total", cache="result", result="miss")
+        return None
+
+    body, etag, fresh_until = unpack_result(cached_result)
+    if fresh_until < time.time():
+        app.ctx.metrics.inc("kinoserver_cache_total", cache="result", result="stale")
+        if key not in app.ctx.refreshing:
+            app.ctx.refreshing.add(key)
+            app.add_task(refresh_result_in_background(ctx, key))
+    else:
+        app.ctx.metrics.inc("kinoserver_cache_total", cache="result", result="hit")
+    return body, etag
+
+
+async def get_cached_result(request, ctx):
+    key = result_key(ctx)
+    cached_result = await lookup_result(ctx, key)
+    if cached_result is None:
+        async with admission(request):
+            return await refresh_result(ctx, key)
+    return cached_result
+
+
+@dataclasses.dataclass(frozen=True)
+class Iframe:
+    src_name: str
+    iframe: str
+    translate: str
+    quality: str
+
+    def to_dict(self):
+        return {
+            "iframe": self.iframe,
+            "translate": self.translate,
+            "quality": self.quality,
+        }
 
 
 def format_result(src_name, iframe_url, translate, quality):
-    return (
-        f'"{src_name.strip()}":{{'
-        f'"iframe":"{iframe_url.strip()}",'
-        f'"translate":"{translate.strip()}",'
-        f'"quality":"{quality.strip()}"'
-        f"}}"
+    return Iframe(
+        src_name.strip(), iframe_url.strip(), translate.strip(), quality.strip()
     )
 
 
+def encode_iframes(iframes):
+    return orjson.dumps({iframe.src_name: iframe.to_dict() for iframe in iframes})
+
+
+def dump_iframes(iframes):
+    return orjson.dumps([dataclasses.astuple(iframe) for iframe in iframes])
+
+
+def load_iframes(data):
+    return [Iframe(*fields) for fields in orjson.loads(data)]
+
+
+def make_etag(body):
+    return f'"{hashlib.blake2b(body, digest_size=12).hexdigest()}"'
+
+
+def accepted_encoding(request):
+    accepted = set()
+    for part in request.headers.get("accept-encoding", "").split(","):
+        coding, _, params = part.partition(";")
+        if params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            accepted.add(coding.strip().lower())
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+def compress(body, etag, encoding):
+    key = (etag, encoding)
+    compressed = app.ctx.compressed.get(key)
+    if compressed is not None:
+        app.ctx.compressed.move_to_end(key)
+        return compressed
+    if encoding == "br":
+        compressed = brotli.compress(body)
+    else:
+        compressed = gzip.compress(body)
+    app.ctx.compressed[key] = compressed
+    if len(app.ctx.compressed) > COMPRESS_CACHE_SIZE:
+        app.ctx.compressed.popitem(last=False)
+    return compressed
+
+
+def payload_response(
+    request, body, etag=None, content_type="application/json; charset=utf-8"
+):
+    # serialized payload with ETag, If-None-Match and gzip/brotli support
+    etag = etag or make_etag(body)
+    headers = {"ETag": etag, "Vary": "Accept-Encoding"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        if etag in tags or "*" in tags:
+            return empty(status=304, headers=headers)
+    if len(body) >= COMPRESS_MIN_SIZE:
+        encoding = accepted_encoding(request)
+        if encoding is not None:
+            body = compress(body, etag, encoding)
+            headers["Content-Encoding"] = encoding
+    return raw(body, headers=headers, content_type=content_type)
+
+
 @app.get("/search/<term>")
 async def search_kinopoisk(request, term):
     if not term:
         return text("No term string provided")
 
-    api_request = SearchByKeywordRequest(unquote(term))
-    response = kinopoisk_api_client.films.send_search_by_keyword_request(api_request)
-    movies = [
-        {
-            "id": film.film_id,
-            "title": (film.name_ru or film.name_en or film.name_original)
-            + f" ({film.year})",
-            "poster": film.poster_url_preview,
-        }
-        for film in response.films
-        if film.year not in [None, "None", "null"]
-    ]
+    term = unquote(term)
+    movies = app.ctx.title_index.search(term, SEARCH_LIMIT)
+    if len(movies) < SEARCH_LOCAL_MIN_RESULTS:
+        movies = await search_films(request, term)
+    else:
+        app.ctx.metrics.inc("kinoserver_cache_total", cache="title_index", result="hit")
 
     if not movies:
         return json([])
@@ -578,27 +2516,15 @@ async def shiki_info(request, shiki):
     if shiki_id == 0:
         return json({})
 
-    url = f"https://kodikapi.com/search?token={KODIK_TOKEN}&shikimori_id={shiki_id}"
-    try:
-        async with CachedSession(cache=app.ctx.backend) as session:
-            async with session.get(url, timeout=5) as response:
-                response.raise_for_status()
-                response = await response.json()
-                results = response.get("results", [])
-                if not results:
-                    return json([])
-
-                first = results[0]
-                res = {
-                    "name_ru": first.get("title"),
-                    "name_en": first.get("title_orig"),
-                    "slogan": first.get("other_title"),
-                    "year": first.get("year"),
-                }
-
-                return json(res)
+    try:
+        entry = await get_kodik("shikimori_id", shiki_id, request)
+    except SanicException:
+        raise
     except Exception as e:
         raise SanicException("Failed to fetch data", status_code=500) from e
+    if not entry["translations"]:
+        return json([])
+    return json(entry["info"])
 
 
 @app.get("/kp_info/<kp_id>")
@@ -607,9 +2533,7 @@ async def kinopoisk_info(request, kp_id):
         return text("No valid kp_id provided")
     if kp_id == 0:
         return json({})
-    request_by_id = FilmRequest(int(kp_id))
-    response_by_id = kinopoisk_api_client.films.send_film_request(request_by_id)
-    film_by_id = response_by_id.film
+    film_by_id = await get_film(int(kp_id), request=request)
     film_dict = dataclasses.asdict(film_by_id)
     for key, value in film_dict.items():
         if isinstance(value, Enum):
@@ -620,11 +2544,175 @@ async def kinopoisk_info(request, kp_id):
     )
 
 
+TOP_PERIODS = {
+    "all": "get_top_video_stats",
+    "30d": "get_top_video_stats_30_days",
+    "7d": "get_top_video_stats_7_days",
+    "24h": "get_top_video_stats_1_days",
+}
+TOP_TYPE_FILTERS = (None, "FilmType.FILM", "FilmType.TV_SERIES")
+# video stats row fields as /top returns them
+TOP_META_FIELDS = (
+    "kp_id",
+    "cover",
+    "title",
+    "year",
+    "rating_kp",
+    "rating_imdb",
+    "url_kp",
+    "url_imdb",
+    "type",
+)
+TOP_TYPE_LABELS = {
+    "FilmType.FILM": "🎬Фильм",
+    "FilmType.VIDEO": "🎬Видео",
+    "FilmType.TV_SERIES": "🎬Сериал",
+    "FilmType.MINI_SERIES": "🎬Мини-сериал",
+    "FilmType.TV_SHOW": "🎬ТВ-шоу",
+}
+
+
+def replace_values(obj):
+    if isinstance(obj, dict):
+        return {k: replace_values(v) for k, v in obj.items()}
+    elif isinstance(obj, tuple):
+        return tuple(replace_values(item) for item in obj)
+    elif isinstance(obj, list):
+        return [replace_values(item) for item in obj]
+    elif isinstance(obj, str):
+        return TOP_TYPE_LABELS.get(obj, obj)
+    return obj
+
+
+def dump_top(data):
+    return ujson.dumps(data, ensure_ascii=False, escape_forward_slashes=False)
+
+
+def load_top_video_stats(period, type_filter):
+    return getattr(db_client(), TOP_PERIODS[period])(type=type_filter)
+
+
+def load_top_snapshot():
+    db = db_client()
+    return {
+        f"{period}:{type_filter}": getattr(db, method)(type=type_filter)
+        for period, method in TOP_PERIODS.items()
+        for type_filter in TOP_TYPE_FILTERS
+    }
+
+
+async def wait_stats_inserts():
+    deadline = time.monotonic() + TOP_REBUILD_WAIT
+    while time.monotonic() < deadline:
+        await app.ctx.redis.zremrangebyscore("top:inserting", 0, time.time())
+        if not await app.ctx.redis.zcard("top:inserting"):
+            return
+        await asyncio.sleep(0.1)
+    logger.warning("Stats inserts still running, rebuilding top anyway")
+
+
+async def rebuild_top():
+    # new stats inserts are held and running ones finish before the INCR, so
+    # every view is either in this DB snapshot or in its delta set, not both
+    await app.ctx.redis.set("top:rebuilding", 1, ex=TOP_REBUILD_HOLD)
+    try:
+        await wait_stats_inserts()
+        generation = await app.ctx.redis.incr("top:generation")
+        boards = await run_db(load_top_snapshot)
+        snapshot = {"generation": generation, "boards": boards}
+        await app.ctx.redis.set("top:snapshot", dump_top(snapshot))
+    finally:
+        await app.ctx.redis.delete("top:rebuilding")
+    await app.ctx.redis.delete(f"top:delta:{generation - 1}")
+    logger.info(f"Top snapshot {generation} rebuilt, PID: {os.getpid()}")
+
+
+async def rebuild_top_periodically():
+    while True:
+        try:
+            if await acquire_lease("lease:top_rebuild", TOP_REBUILD_INTERVAL):
+                await rebuild_top()
+        except Exception as e:
+            logger.warning(f"Failed rebuild top: {e}")
+        await asyncio.sleep(60)
+
+
+async def count_top_views(rows, generation):
+    # per-view increments on top of the DB snapshot of that generation
+    try:
+        delta_key = f"top:delta:{generation}"
+        pipe = app.ctx.redis.pipeline(transaction=False)
+        metas = {}
+        for row in rows:
+            meta = dict(zip(TOP_META_FIELDS, row))
+            meta["type"] = str(meta["type"])
+            pipe.zincrby(delta_key, 1, str(meta["kp_id"]))
+            metas[str(meta["kp_id"])] = dump_top(meta)
+        pipe.expire(delta_key, TOP_REBUILD_INTERVAL * 2)
+        hset_recent(pipe, TOP_TITLES_KEY, metas, TITLE_INDEX_SIZE)
+        await pipe.execute()
+    except Exception as e:
+        logger.warning(f"Failed count top views: {e}")
+
+
+async def render_top(period, type_filter):
+    snapshot = await redis_get("top:snapshot")
+    if snapshot is None:
+        if await acquire_lease("lease:top_rebuild", TOP_REBUILD_INTERVAL):
+            await rebuild_top()
+            snapshot = await redis_get("top:snapshot")
+        if snapshot is None:
+            return None
+    snapshot = ujson.loads(snapshot)
+    board = snapshot["boards"][f"{period}:{type_filter}"] or []
+    size = max(len(board), TOP_SIZE) if board else TOP_SIZE
+
+    rows = {str(row["kp_id"]): dict(row) for row in board}
+    delta = await app.ctx.redis.zrange(
+        f"top:delta:{snapshot['generation']}", 0, -1, withscores=True
+    )
+    new_ids = []
+    for kp_id, views in delta:
+        kp_id = kp_id.decode()
+        if kp_id in rows:
+            rows[kp_id]["views_count"] += int(views)
+        else:
+            new_ids.append((kp_id, int(views)))
+    if new_ids:
+        metas = await app.ctx.redis.hmget(
+            TOP_TITLES_KEY, [kp_id for kp_id, _ in new_ids]
+        )
+        for (kp_id, views), meta in zip(new_ids, metas):
+            if meta is None:
+                continue
+            row = ujson.loads(meta)
+            if type_filter is None or row["type"] == type_filter:
+                row["views_count"] = views
+                rows[kp_id] = row
+
+    board = sorted(rows.values(), key=lambda row: row["views_count"], reverse=True)
+    return dump_top(replace_values(board[:size])).encode()
+
+
+async def get_top_board(period, type_filter):
+    key = (period, type_filter)
+    cached_board = app.ctx.top_boards.get(key)
+    if cached_board is not None and cached_board[1] > time.monotonic():
+        app.ctx.metrics.inc("kinoserver_cache_total", cache="top", result="hit")
+        return cached_board[0]
+    app.ctx.metrics.inc("kinoserver_cache_total", cache="top", result="miss")
+    board = await single_flight(
+        app.ctx.top_renders, key, lambda: render_top(period, type_filter)
+    )
+    if board is not None:
+        app.ctx.top_boards[key] = (board, time.monotonic() + TOP_RENDER_TTL)
+    return board
+
+
 @app.get("/top/<type>")
 async def top(request, type):
     if not type:
         return text("No valid type provided")
-    db = DatabaseClient()
     type_filter = request.args.get("type")
     if type_filter == "movie":
         type_filter = "FilmType.FILM"
@@ -633,52 +2721,108 @@ async def top(request, type):
     if type_filter == "all":
         type_filter = None
 
-    data = None
-
-    if type == "all":
-        data = db.get_top_video_stats(type=type_filter)
-    if type == "30d":
-        data = db.get_top_video_stats_30_days(type=type_filter)
-    if type == "7d":
-        data = db.get_top_video_stats_7_days(type=type_filter)
-    if type == "24h":
-        data = db.get_top_video_stats_1_days(type=type_filter)
-
-    replacements = {
-        "FilmType.FILM": "🎬Фильм",
-        "FilmType.VIDEO": "🎬Видео",
-        "FilmType.TV_SERIES": "🎬Сериал",
-        "FilmType.MINI_SERIES": "🎬Мини-сериал",
-        "FilmType.TV_SHOW": "🎬ТВ-шоу",
-    }
-
-    def replace_values(obj):
-        if isinstance(obj, dict):
-            return {k: replace_values(v) for k, v in obj.items()}
-        elif isinstance(obj, tuple):
-            return tuple(replace_values(item) for item in obj)
-        elif isinstance(obj, list):
-            return [replace_values(item) for item in obj]
-        elif isinstance(obj, str):
-            return replacements.get(obj, obj)
-        return obj
+    if type not in TOP_PERIODS:
+        return json(None)
 
-    data = replace_values(data)
+    board = None
+    if type_filter in TOP_TYPE_FILTERS:
+        try:
+            board = await get_top_board(type, type_filter)
+        except Exception as e:
+            logger.warning(f"Failed render top {type}: {e}")
+    if board is None:
+        data = await run_db(load_top_video_stats, type, type_filter)
+        board = dump_top(replace_values(data)).encode()
 
-    return json(data)
+    return payload_response(request, board)
 
 
 @app.get("/get_pl_list_1")
-# @cached(ttl=CACHE_PL_TTL, serializer=PickleSerializer(), key="pl_key")
 async def get_pl_list_1(request):
-    return text(DatabaseClient().get_pl_1()["data"])
+    body, etag = await get_content("pl_list_1")
+    return payload_response(request, body, etag, "text/plain; charset=utf-8")
 
 
 @app.get("/get_dons")
-# @cached(ttl=CACHE_PL_TTL, serializer=PickleSerializer(), key="dons_key")
 async def get_dons(request):
-    dons = "\n".join([item["name"] for item in DatabaseClient().get_dons()])
-    return text(dons)
+    body, etag = await get_content("dons")
+    return payload_response(request, body, etag, "text/plain; charset=utf-8")
+
+
+@app.get("/metrics")
+async def metrics(request):
+    snapshots = {}
+    try:
+        now = time.time()
+        workers = await app.ctx.redis.hgetall("metrics:workers")
+        for worker, snapshot in workers.items():
+            snapshot = orjson.loads(snapshot)
+            if now - snapshot["ts"] > METRICS_STALE_AFTER:
+                await app.ctx.redis.hdel("metrics:workers", worker)
+                continue
+            snapshots[worker.decode()] = snapshot
+    except Exception as e:
+        logger.warning(f"Failed read worker metrics: {e}")
+    snapshots[worker_name()] = app.ctx.metrics.snapshot()
+    return text(render_metrics(snapshots), content_type="text/plain; version=0.0.4")
+
+
+@app.get("/debug/blocks")
+async def debug_blocks(request):
+    # this worker only, recent blocking callbacks with their stacks
+    if not check_debug_token(request):
+        return json(None, 401)
+    return json(
+        {"worker": worker_name(), "blocks": list(app.ctx.watchdog.blocks)},
+        escape_forward_slashes=False,
+    )
+
+
+@app.get("/debug/profile")
+async def debug_profile(request):
+    # samples this worker's event loop thread, or every thread with threads=all
+    if not check_debug_token(request):
+        return json(None, 401)
+    if app.ctx.profiling:
+        return text("Profile already running", status=409)
+    try:
+        seconds = min(float(request.args.get("seconds", 10)), PROFILE_MAX_SECONDS)
+    except ValueError:
+        return text("Not float", status=400)
+    thread_ids = None
+    if request.args.get("threads") != "all":
+        thread_ids = {app.ctx.watchdog.thread_id}
+    app.ctx.profiling = True
+    try:
+        loop = asyncio.get_running_loop()
+        folded = await loop.run_in_executor(None, sample_stacks, thread_ids, seconds)
+    finally:
+        app.ctx.profiling = False
+    return text(folded, headers={"x-worker": worker_name()})
+
+
+@app.on_request
+async def start_timer(request):
+    request.ctx.started = time.perf_counter()
+    # lets the loop watchdog name the route of a blocking callback
+    route = request.route.path if request.route else "unmatched"
+    app.ctx.task_routes[asyncio.current_task()] = route
+
+
+@app.on_response
+async def observe_route(request, response):
+    started = getattr(request.ctx, "started", None)
+    if started is None:
+        return
+    route = request.route.path if request.route else "unmatched"
+    app.ctx.metrics.observe(
+        "kinoserver_route_latency_seconds",
+        time.perf_counter() - started,
+        route=route,
+    )
+    app.ctx.metrics.inc(
+        "kinoserver_responses_total", route=route, status=response.status
+    )
 
 
 @app.exception(ServerError)
@@ -689,16 +2833,57 @@ async def test(request, exception):
     )
 
 
+async def rolling_restart(names):
+    # one worker at a time, the next starts once its replacement serves
+    for name in names:
+        starts = app.m.workers.get(name, {}).get("starts", 0)
+        app.m.restart(name, zero_downtime=True)
+        deadline = time.monotonic() + RESTART_WORKER_TIMEOUT
+        while time.monotonic() < deadline:
+            await asyncio.sleep(0.5)
+            worker = app.m.workers.get(name, {})
+            if worker.get("starts", 0) > starts and worker.get("state") == "ACKED":
+                break
+        else:
+            logger.warning(f"Worker {name} did not restart in time")
+
+
 @app.get("/restart/<password>")
 async def restart_handler(request, password):
     if password != "blablabla":
         return json(None, 401)
-    for name, worker in request.app.m.workers.items():
-        if worker.get("server"):
-            request.app.m.restart(name)
+    # the worker running the restart goes last, the task ends with it
+    names = [
+        name
+        for name, worker in request.app.m.workers.items()
+        if worker.get("server") and name != request.app.m.name
+    ]
+    names.append(request.app.m.name)
+    request.app.add_task(rolling_restart(names))
     return json(None, status=202)
 
 
+def make_connector():
+    return TCPConnector(
+        limit=HTTP_POOL_LIMIT,
+        limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+        ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+    )
+
+
+def make_hdrezka_connector():
+    if HDREZKA_SOCKET:
+        return UnixConnector(
+            path=HDREZKA_SOCKET,
+            limit=HDREZKA_MAX_IN_FLIGHT,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+        )
+    return TCPConnector(
+        limit=HDREZKA_MAX_IN_FLIGHT, keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT
+    )
+
+
 @app.before_server_start
 async def init_app(app, loop):
     app.ctx.backend = RedisBackend(
@@ -706,6 +2891,93 @@ async def init_app(app, loop):
         address=REDIS_ADDRESS,
         expire_after=timedelta(hours=3),
     )
+    app.ctx.redis = aioredis.from_url(REDIS_ADDRESS)
+    # one keep-alive pool per worker, shared by every provider call
+    app.ctx.http = CachedSession(cache=app.ctx.backend, connector=make_connector())
+    app.ctx.http_local = ClientSession(connector=make_connector())
+    app.ctx.hdrezka = ClientSession(connector=make_hdrezka_connector())
+    app.ctx.kinopoisk_pool = ThreadPoolExecutor(
+        max_workers=KINOPOISK_POOL_SIZE, thread_name_prefix="kinopoisk"
+    )
+    app.ctx.db_pool = ThreadPoolExecutor(
+        max_workers=DB_POOL_SIZE, thread_name_prefix="db"
+    )
+    app.ctx.film_requests = {}
+    app.ctx.kodik_requests = {}
+    app.ctx.hdrezka_calls = {}
+    app.ctx.blocklist = {}
+    app.ctx.blocklist_checks = {}
+    app.ctx.content = {}
+    app.ctx.content_loads = {}
+    app.ctx.stats_queue = asyncio.Queue(maxsize=STATS_QUEUE_SIZE)
+    app.ctx.top_boards = {}
+    app.ctx.title_index = TitleIndex(TITLE_INDEX_SIZE)
+    app.ctx.compressed = collections.OrderedDict()
+    app.ctx.geo_cache = collections.OrderedDict()
+    app.ctx.metrics = Metrics()
+    app.ctx.top_renders = {}
+    app.ctx.refreshing = set()
+    app.ctx.inflight = {}
+    app.ctx.admitted = 0
+    app.ctx.health = None
+    app.ctx.loop_lag = 0
+    app.ctx.task_routes = weakref.WeakKeyDictionary()
+    app.ctx.profiling = False
+    app.ctx.provider_limits = {
+        provider.name: asyncio.Semaphore(provider.max_in_flight)
+        for provider in PROVIDERS
+    }
+    app.ctx.breakers = {
+        provider.name: CircuitBreaker(provider.name, provider.slow_call)
+        for provider in PROVIDERS
+    }
+
+
+@app.after_server_start
+async def start_background_tasks(app, loop):
+    app.add_task(listen_invalidations(), name="listen_invalidations")
+    app.add_task(flush_stats(), name="flush_stats")
+    app.add_task(rebuild_top_periodically(), name="rebuild_top")
+    app.add_task(load_title_index(), name="load_title_index")
+    app.add_task(prewarm_periodically(), name="prewarm")
+    app.add_task(flush_metrics(), name="flush_metrics")
+    app.add_task(monitor_loop_lag(), name="monitor_loop_lag")
+    app.add_task(check_health_periodically(), name="check_health")
+    app.ctx.watchdog = LoopWatchdog(loop)
+    app.ctx.watchdog.start()
+    app.add_task(app.ctx.watchdog.beat(), name="loop_watchdog")
+
+
+@app.before_server_stop
+async def drain_fanouts(app, loop):
+    # let running fan-outs store their results, other workers wait on them
+    pending = list(app.ctx.inflight.values())
+    if pending:
+        await asyncio.wait(pending, timeout=FANOUT_LEASE_TTL)
+
+
+async def drain_stats():
+    # after_server_stop, rows queued by requests finishing during the
+    # graceful shutdown are in the queue by then
+    await app.cancel_task("flush_stats", raise_exception=False)
+    queue = app.ctx.stats_queue
+    rows = []
+    while not queue.empty():
+        rows.append(queue.get_nowait())
+    if rows:
+        await run_db(insert_stats_batch, rows)
+
+
+@app.after_server_stop
+async def close_app(app, loop):
+    await drain_stats()
+    app.ctx.watchdog.stop()
+    await app.ctx.http.close()
+    await app.ctx.http_local.close()
+    await app.ctx.hdrezka.close()
+    app.ctx.kinopoisk_pool.shutdown(wait=False)
+    app.ctx.db_pool.shutdown(wait=True)
+    await app.ctx.redis.close()
 
 
 if __name__ == "__main__":
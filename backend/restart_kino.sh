@@ -1,8 +1,14 @@
-#!/usr/bin/sh
-ps -ef | grep 'kinoserver:app' | awk '{print $2}'  | xargs -r kill -9
-sudo /usr/bin/lsof -i -P |grep 5788| grep 'python3.1' | awk '{print $2}'| xargs -r kill -9
-rm /home/bot/kino_server_int.log
-rm /home/bot/kino_server.log
-rm /home/bot/demo_cache.sqlite
-echo -e 'AUTH PrE$$ton2334214@!\nflushall' | redis-cli
-nohup /home/bot/.local/bin/sanic kinoserver:app -p 5788 -H 0.0.0.0 --workers=8 2>&1 >> kinoserver.log &
\ No newline at end of file
+#!/usr/bin/sh
+# Rolling restart, workers are replaced one by one and the caches in Redis stay
+# warm. Cache namespaces given as arguments are dropped first, e.g. after a
+# provider change: ./restart_kino.sh provider result
+[ -n "$REDISCLI_AUTH" ] || REDISCLI_AUTH='PrE$$ton2334214@!'
+export REDISCLI_AUTH
+for namespace in "$@"; do
+    redis-cli --scan --pattern "$namespace:*" | xargs -r -n 500 redis-cli unlink > /dev/null
+done
+if pgrep -f 'kinoserver:app' > /dev/null; then
+    curl -fsS http://127.0.0.1:5788/restart/blablabla > /dev/null
+else
+    nohup /home/bot/.local/bin/sanic kinoserver:app -p 5788 -H 0.0.0.0 --workers=8 2>&1 >> kinoserver.log &
+fi